@@ -0,0 +1,257 @@
+import argparse
+import json
+import math
+import multiprocessing
+import platform
+import random
+import sys
+import time
+from datetime import datetime, timezone
+
+import CSP_Engine as csp
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory is left out there
+    resource = None
+
+subject_names = ['English', 'Math', 'Science', 'History', 'Geography', 'Hindi', 'Computers', 'Civics', 'Economics',
+                 'Art', 'Music', 'Language', 'PE', 'Drama', 'Dance', 'Library', 'Craft', 'Yoga']
+
+day_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+
+# name, kind, generate_school arguments
+suites = {
+    'quick': [
+        ('small-feasible', 'feasible', dict(seed=1, num_grades=2, num_sections=2, num_slots=4, overlap=2, slack=1.5)),
+        ('small-tight', 'tight', dict(seed=2, num_grades=2, num_sections=2, num_slots=4, overlap=0, slack=1.0)),
+        ('small-infeasible', 'infeasible', dict(seed=3, num_grades=2, num_sections=2, num_slots=4, slack=0.8)),
+        ('small-hidden-infeasible', 'infeasible', dict(seed=4, num_grades=2, num_sections=3, num_slots=4,
+                                                       sole_teacher=True)),
+    ],
+    'full': [
+        ('medium-feasible', 'feasible', dict(seed=11, num_grades=6, num_sections=3, num_slots=6, overlap=2, slack=1.4)),
+        ('medium-tight', 'tight', dict(seed=12, num_grades=6, num_sections=3, num_slots=6, overlap=1, slack=1.05)),
+        ('medium-infeasible', 'infeasible', dict(seed=13, num_grades=6, num_sections=3, num_slots=6, slack=0.9)),
+        ('large-feasible', 'feasible', dict(seed=21, num_grades=12, num_sections=4, num_days=6, num_slots=8,
+                                            overlap=2, slack=1.3)),
+        ('large-tight', 'tight', dict(seed=22, num_grades=12, num_sections=4, num_days=6, num_slots=8,
+                                      overlap=1, slack=1.05)),
+    ],
+}
+suites['full'] = suites['quick'] + suites['full']
+
+solver_names = ['backtracking', 'backtracking_ac', 'local', 'portfolio', 'decomposed']
+
+
+def generate_school(seed, num_grades=4, num_sections=2, num_days=5, num_slots=4, overlap=1, slack=1.25,
+                    preferences=0.3, sole_teacher=False):
+    # A school built around a hidden timetable, so it is feasible whenever slack >= 1. Each day type has
+    # as many subjects as there are slots, as the capacity precheck expects. Teachers are hired subject
+    # by subject while the hidden timetable is filled in; each then gets `overlap` extra random
+    # qualifications and max_hours of slack times the hours they teach in it, rounded down below 1.
+    # sole_teacher leaves one (grade, subject) to a single teacher, which no timetable can fit once a
+    # grade has more sections than non-adjacent slots, however many hours that teacher has.
+    # Returns (grades, teacher_pool, day_schedule_map, time_slots).
+    rng = random.Random(seed)
+    time_slots = {slot: f"Period {slot}" for slot in range(1, num_slots + 1)}
+    day_schedule_map = {day: 1 + i % 2 for i, day in enumerate(day_names[:num_days])}
+    names = [subject_names[i % len(subject_names)] + (f' {i // len(subject_names) + 1}' * (i >= len(subject_names)))
+             for i in range(2 * num_slots)]
+    subjects_day = {1: names[:num_slots], 2: names[num_slots:]}
+    sections = [chr(ord('A') + i) for i in range(num_sections)]
+    grades = [csp.Grade(grade_number, sections, subjects_day) for grade_number in range(1, num_grades + 1)]
+
+    hidden = {}  # (grade, day, section, slot) -> subject
+    for grade in grades:
+        for day, day_type in day_schedule_map.items():
+            for section in sections:
+                for slot, subject in zip(time_slots, rng.sample(subjects_day[day_type], num_slots)):
+                    hidden[(grade.grade_number, day, section, slot)] = subject
+
+    teachers = {}  # name -> [qualifications, classes in the hidden timetable]
+    by_subject = {}
+    busy = {}  # (day, slot) -> {teacher: (grade, section)}
+    for day in day_schedule_map:
+        for slot in time_slots:
+            for grade in grades:
+                for section in sections:
+                    subject = hidden[(grade.grade_number, day, section, slot)]
+                    candidates = [name for name in by_subject.get(subject, ())
+                                  if name not in busy.get((day, slot), {}) and
+                                  all(busy.get((day, other), {}).get(name, (None,))[0] != grade.grade_number
+                                      for other in (slot - 1, slot + 1))]
+                    if candidates:
+                        name = min(candidates, key=lambda candidate: teachers[candidate][1])
+                    else:
+                        name = f"T{len(teachers) + 1}"
+                        teachers[name] = [set(), 0]
+                        by_subject.setdefault(subject, []).append(name)
+                    teachers[name][0].add((grade.grade_number, subject))
+                    teachers[name][1] += 1
+                    busy.setdefault((day, slot), {})[name] = (grade.grade_number, section)
+
+    pairs = sorted({(grade.grade_number, subject) for grade in grades for day_type in (1, 2)
+                    for subject in subjects_day[day_type]})
+    for qualifications, _ in teachers.values():
+        qualifications.update(rng.sample(pairs, min(overlap, len(pairs))))
+    max_classes = {name: max(1, math.ceil(classes * slack) if slack >= 1 else int(classes * slack))
+                   for name, (_, classes) in teachers.items()}
+
+    if sole_teacher:
+        # only a pair the hidden timetable teaches is sure to have a teacher
+        pair = rng.choice(sorted({(key[0], subject) for key, subject in hidden.items()}))
+        holders = [name for name, (qualifications, _) in teachers.items() if pair in qualifications]
+        keeper = holders[0]
+        for name in holders[1:]:
+            teachers[name][0].discard(pair)
+        needed = sum(1 for key, subject in hidden.items() if (key[0], subject) == pair)
+        max_classes[keeper] += needed
+
+    teacher_pool = []
+    for name, (qualifications, _) in teachers.items():
+        preferred_class = None
+        if rng.random() < preferences:
+            preferred_class = rng.choice(sorted(busy_class for busy_slot in busy.values()
+                                                for teacher, busy_class in busy_slot.items() if teacher == name))
+        teacher_pool.append(csp.Teacher(name, sorted(qualifications), preferred_class, 2 * max_classes[name]))
+    return grades, teacher_pool, day_schedule_map, time_slots
+
+
+def build_model(grades, teacher_pool, day_schedule_map, time_slots):
+    return csp.build_model(grades, teacher_pool, time_slots, day_schedule_map)
+
+
+def precheck(grades, teacher_pool, day_schedule_map):
+    # 'infeasible' when the capacity precheck alone rules the school out
+    return 'passed' if csp.precheck(grades, teacher_pool, day_schedule_map) is None else 'infeasible'
+
+
+def run_solver(solver, model, time_limit):
+    # (status, solution, nodes, backtracks) with status 'solved', 'infeasible' or 'timeout'
+    constraints = csp.constraints
+    if solver in ('backtracking', 'backtracking_ac'):
+        engine = csp.CSPEngine(model, constraints, forward_checking=True, backjumping=True,
+                               arc_consistency=solver == 'backtracking_ac')
+        deadline = time.monotonic() + time_limit
+        status = csp.PAUSED
+        while status == csp.PAUSED and time.monotonic() < deadline:
+            status = engine.resume(max_nodes=2000)
+        solution = list(engine.index.values) if status == csp.SOLVED else None
+        return _status(status), solution, engine.stats['nodes'], engine.stats['backtracks']
+    if solver == 'local':
+        engine = csp.LocalSearchEngine(model, constraints, time_limit=time_limit)
+        solution, _ = engine.solve()
+        return 'solved' if solution else 'timeout', solution, engine.stats['steps'], None
+    if solver == 'portfolio':
+        solution, conflicts, reports = csp.portfolio_search(model, constraints, 4, time_limit=time_limit)
+        status = 'solved' if solution else 'infeasible' if conflicts is not None else 'timeout'
+        return (status, solution, sum(report.get('nodes', 0) for report in reports),
+                sum(report.get('backtracks', 0) for report in reports))
+    if solver == 'decomposed':
+        solution, conflicts, reports = csp.decomposed_search(model, constraints, time_limit=time_limit,
+                                                             forward_checking=True, backjumping=True)
+        status = 'solved' if solution else 'infeasible' if conflicts is not None else 'timeout'
+        return (status, solution, sum(report.get('nodes', 0) for report in reports),
+                sum(report.get('backtracks', 0) for report in reports))
+    raise ValueError(f"Unknown solver '{solver}'")
+
+
+def _status(status):
+    return {csp.SOLVED: 'solved', csp.FAILED: 'infeasible'}.get(status, 'timeout')
+
+
+def _run_case(arguments, solver, time_limit, results):
+    # runs in its own process so that peak memory belongs to this case alone
+    school = generate_school(**arguments)
+    model = build_model(*school)
+    start = time.perf_counter()
+    status, solution, nodes, backtracks = run_solver(solver, model, time_limit)
+    wall_time = time.perf_counter() - start
+    result = {'status': status, 'wall_time': round(wall_time, 4), 'nodes': nodes, 'backtracks': backtracks,
+              'peak_memory_kb': None, 'hard_violations': None, 'soft_penalty': None}
+    if solution:
+        result['hard_violations'], result['soft_penalty'] = csp.timetable_penalties(model, csp.constraints, solution)
+    if resource is not None:
+        result['peak_memory_kb'] = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    results.put(result)
+
+
+def run_suite(cases, solvers, time_limit):
+    results = []
+    for name, kind, arguments in cases:
+        school = generate_school(**arguments)
+        start = time.perf_counter()
+        precheck_result = precheck(school[0], school[1], school[2])
+        precheck_time = time.perf_counter() - start
+        model = build_model(*school)
+        for solver in solvers:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_run_case, args=(arguments, solver, time_limit, queue))
+            process.start()
+            try:
+                result = queue.get(timeout=2 * time_limit + 60)
+            except Exception:
+                result = {'status': 'killed', 'wall_time': None, 'nodes': None, 'backtracks': None,
+                          'peak_memory_kb': None, 'hard_violations': None, 'soft_penalty': None}
+                process.kill()
+            process.join()
+            result = dict({'instance': name, 'kind': kind, 'solver': solver, 'variables': len(model.variable_names),
+                           'teachers': len(school[1]), 'precheck': precheck_result,
+                           'precheck_time': round(precheck_time, 4)}, **result)
+            results.append(result)
+            print(f"{name:26} {solver:16} {result['status']:10} {result['wall_time']}s "
+                  f"nodes={result['nodes']} peak={result['peak_memory_kb']}KB", flush=True)
+    return results
+
+
+def compare(results, previous):
+    # wall time and nodes against an earlier results file, for the cases both runs contain
+    earlier = {(result['instance'], result['solver']): result for result in previous['results']}
+    print("\nChange against the previous run:")
+    for result in results:
+        old = earlier.get((result['instance'], result['solver']))
+        if old is None:
+            continue
+        changes = []
+        for field in ('wall_time', 'nodes'):
+            if old.get(field) and result.get(field) is not None:
+                changes.append(f"{field} x{result[field] / old[field]:.2f}")
+        if old['status'] != result['status']:
+            changes.append(f"status {old['status']} -> {result['status']}")
+        print(f" - {result['instance']} / {result['solver']}: {', '.join(changes) or 'no change'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the timetable solvers on generated schools.")
+    parser.add_argument('--suite', choices=sorted(suites), default='quick')
+    parser.add_argument('--solvers', default='backtracking,local',
+                        help=f"comma separated, from {', '.join(solver_names)}")
+    parser.add_argument('--time-limit', type=float, default=10.0, help="seconds per solver and school")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help="an earlier results file to compare against")
+    args = parser.parse_args()
+
+    solvers = args.solvers.split(',')
+    for solver in solvers:
+        if solver not in solver_names:
+            parser.error(f"unknown solver '{solver}'")
+    results = run_suite(suites[args.suite], solvers, args.time_limit)
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'suite': args.suite,
+        'time_limit': args.time_limit,
+        'results': results,
+    }
+    csp._replace_file(args.output, lambda file: json.dump(report, file, indent=2))
+    print(f"Results written to {args.output}.")
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
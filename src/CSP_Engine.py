@@ -1,9 +1,47 @@
+import copy
 import csv
+import hashlib
+import json
+import math
+import os
+import pickle
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from array import array
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, TimeoutError, as_completed, wait
+from heapq import heapify, heappop, heappush
+from multiprocessing import Event
 
 _export = True
 
 _print_remaining_hours = True
 
+_forward_checking = True
+
+_arc_consistency = False
+
+_backjumping = True
+
+_print_search_stats = False
+
+_profile_search = False  # time every constraint and variable selection, printed with the search statistics
+
+_solver = 'backtracking'  # or 'local' for min-conflicts local search
+
+_portfolio_workers = 0  # race this many differently configured CSPEngines in separate processes, 0 to run one
+
+_decompose = False  # solve the parts of the school that share no constraints separately, in parallel
+
+_symmetry = None  # 'infeasibility' or 'solutions' to break interchangeable sections and teachers, see CSPEngine
+
+_cache_dir = None  # e.g. 'cache': reuse the stored timetable while the school is unchanged, see SolutionCache
+
+_time_limit = None  # seconds; backtracking exports the most complete timetable by then, see CSPEngine.anytime_search
+
 time_slots = {
     1: '9:00am - 11:00am',
     2: '11:00am - 1:00pm',
@@ -67,248 +105,2460 @@ teacher_pool = [
     Teacher("T9", [(2, 'Math')]),
 ]
 
-# finds how many times a particular subject needs to be scheduled for a given grade across all sections and days
-required_assignments = {}
-for grade in grades:
-    for day, day_type in day_schedule_map.items():
-        subjects = grade.subjects_day[day_type]
-        for subject in subjects:
-            key = (grade.grade_number, subject)
-            required_assignments[key] = required_assignments.get(key, 0) + len(grade.sections)
-
-# checks if the available teachers can handle the total workload
-subject_capacity = {}
-for (g_num, subj), needed in required_assignments.items():
-    teachers_for_subj = [t for t in teacher_pool if (g_num, subj) in t.grade_subject_pairs]
-    total_capacity = sum((t.max_hours // 2) for t in teachers_for_subj)
-    subject_capacity[(g_num, subj)] = total_capacity
-    if needed > total_capacity:
-        if len(teachers_for_subj) == 1:
-            t = teachers_for_subj[0]
-            print("\nATTENTION: Scheduling Issue Detected!")
-            print(f"The subject '{subj}' in Grade {g_num} requires {needed} assignments,")
-            print(
-                f"but the only qualified teacher '{t.name}' can only handle {t.max_hours // 2} assignments (max {t.max_hours} hours).")
-            print("No other teachers are available to cover this subject.")
-            print("Please increase this teacher's max hours or add another qualified teacher for this subject.\n")
-            exit()
-        else:
-            print("\nATTENTION: Scheduling Issue Detected!")
-            print(f"The subject '{subj}' in Grade {g_num} requires {needed} assignments,")
-            print("but even combining all qualified teachers' hours, it's not enough.")
-            print("Please adjust max hours or add more qualified teachers for this subject.\n")
-            exit()
-
-# check if each teacher can handle their own assignments
-teacher_mandatory_load = {}
-for (g_num, subj), needed in required_assignments.items():
-    teachers_for_subj = [t for t in teacher_pool if (g_num, subj) in t.grade_subject_pairs]
-    if len(teachers_for_subj) == 1:
-        t = teachers_for_subj[0]
-        teacher_mandatory_load[t.name] = teacher_mandatory_load.get(t.name, 0) + needed
-
-# Now check if any teacher's mandatory load exceeds their capacity
-for t in teacher_pool:
-    if t.name in teacher_mandatory_load:
-        mandatory_assignments = teacher_mandatory_load[t.name]
-        if mandatory_assignments > (t.max_hours // 2):
-            sole_subjects = []
-            for (g_num, subj), needed in required_assignments.items():
-                teachers_for_subj = [tt for tt in teacher_pool if (g_num, subj) in tt.grade_subject_pairs]
-                if len(teachers_for_subj) == 1 and teachers_for_subj[0].name == t.name:
-                    sole_subjects.append((g_num, subj, needed))
-
-            print("\nATTENTION: Global Scheduling Issue Detected!")
-            print(f"Teacher '{t.name}' is the only teacher qualified for these classes and must cover all assignments:")
-            for (g_num, subj, needed) in sole_subjects:
-                print(f" - Grade {g_num}, Subject '{subj}': {needed} assignments (needs {needed * 2} hours)")
-            print(f"\nTotal mandatory assignments for '{t.name}': {teacher_mandatory_load[t.name]} assignments")
-            print(f"But '{t.name}' can only handle {t.max_hours // 2} assignments max (max {t.max_hours} hours).")
-            print("There is no alternative teacher to share the load. Please increase max hours for this teacher")
-            print("or add another qualified teacher for these subjects.\n")
-            exit()
-
-# Now we can start building the CSP, set variables and domains and find any missing teachers
-variables = []
-domains = {}
-missing_teachers = []
-for grade in grades:
-    for day in day_schedule_map.keys():
-        day_type = day_schedule_map[day]
-        for section in grade.sections:
-            for time_slot in time_slots:
-                var_name = f'G{grade.grade_number}_{day}_S{section}_T{time_slot}'
-                variables.append(var_name)
-                domains[var_name] = []
-                for subject in grade.subjects_day[day_type]:
-                    eligible_teachers = [t.name for t in teacher_pool if
-                                         (grade.grade_number, subject) in t.grade_subject_pairs]
-                    if not eligible_teachers:
-                        missing_teachers.append((grade.grade_number, subject))
-                    else:
-                        for teacher_name in eligible_teachers:
-                            domains[var_name].append((subject, teacher_name))
+def qualification_index(teacher_pool):
+    # (grade, subject) -> teachers qualified for it
+    qualified = {}
+    for t in teacher_pool:
+        for pair in t.grade_subject_pairs:
+            qualified.setdefault(pair, []).append(t)
+    return qualified
 
-# Check for missing teachers and exit if any
-if missing_teachers:
-    print("Scheduling Error: The following subjects cannot be scheduled due to a lack of teachers:")
-    for grade_number, subject in set(missing_teachers):
-        print(f"   - Grade {grade_number}: {subject}")
-    print("\nPlease assign teachers to these subjects to continue.")
-    exit()
 
+def capacity_shortfall(required_assignments, qualified):
+    # Max flow from the required assignments of each (grade, subject) to the teachers qualified for
+    # them, each teacher taking at most max_hours // 2. None if every assignment can be covered,
+    # otherwise the smallest group of subjects whose teachers cannot cover them together, as
+    # (subjects, teachers): everything still reachable from the source in the residual graph.
+    demands = list(required_assignments)
+    teachers = list({t.name: t for pair in demands for t in qualified.get(pair, ())}.values())
+    teacher_nodes = {t.name: len(demands) + i for i, t in enumerate(teachers)}
+    source, sink = len(demands) + len(teachers), len(demands) + len(teachers) + 1
+    graph = [[] for _ in range(sink + 1)]  # node -> [target, residual capacity, index of the reverse edge]
 
-def get_teacher_by_name(name):
-    for t in teacher_pool:
-        if t.name == name:
-            return t
+    def add_edge(node, target, capacity):
+        graph[node].append([target, capacity, len(graph[target])])
+        graph[target].append([node, 0, len(graph[node]) - 1])
+
+    for node, pair in enumerate(demands):
+        add_edge(source, node, required_assignments[pair])
+        for t in qualified.get(pair, ()):
+            add_edge(node, teacher_nodes[t.name], required_assignments[pair])
+    for t in teachers:
+        add_edge(teacher_nodes[t.name], sink, max(t.max_hours // 2, 0))
+
+    def levels():
+        # breadth-first distances from the source over edges with capacity left, -1 if unreachable
+        level = [-1] * len(graph)
+        level[source] = 0
+        queue = deque([source])
+        while queue:
+            node = queue.popleft()
+            for target, capacity, _ in graph[node]:
+                if capacity > 0 and level[target] < 0:
+                    level[target] = level[node] + 1
+                    queue.append(target)
+        return level
+
+    def augment(level, pointer):
+        # pushes flow along one shortest path, skipping edges already found to lead nowhere
+        path, nodes = [], [source]
+        while True:
+            node = nodes[-1]
+            if node == sink:
+                flow = min(edge[1] for edge in path)
+                for edge in path:
+                    edge[1] -= flow
+                    graph[edge[0]][edge[2]][1] += flow
+                return flow
+            edges = graph[node]
+            while pointer[node] < len(edges):
+                edge = edges[pointer[node]]
+                if edge[1] > 0 and level[edge[0]] == level[node] + 1:
+                    break
+                pointer[node] += 1
+            else:
+                if node == source:
+                    return 0
+                nodes.pop()
+                path.pop()
+                pointer[nodes[-1]] += 1
+                continue
+            path.append(edge)
+            nodes.append(edge[0])
+
+    # Dinic's algorithm
+    while True:
+        level = levels()
+        if level[sink] < 0:
+            break
+        pointer = [0] * len(graph)
+        while augment(level, pointer):
+            pass
+
+    if all(edge[1] == 0 for edge in graph[source]):
+        return None
+    subjects = [pair for node, pair in enumerate(demands) if level[node] >= 0]
+    return subjects, [t for t in teachers if level[teacher_nodes[t.name]] >= 0]
+
+
+def count_required_assignments(grades, day_schedule_map):
+    # (grade, subject) -> classes needed per week across all sections and days
+    required_assignments = {}
+    for grade in grades:
+        for day, day_type in day_schedule_map.items():
+            subjects = grade.subjects_day[day_type]
+            for subject in subjects:
+                key = (grade.grade_number, subject)
+                required_assignments[key] = required_assignments.get(key, 0) + len(grade.sections)
+    return required_assignments
+
+
+def build_domains(grades, day_schedule_map, time_slots, qualified):
+    # one variable per class and time slot, its domain every (subject, qualified teacher) of that day
+    variables = []
+    domains = {}
+    variable_keys = {}
+    for grade in grades:
+        for day in day_schedule_map.keys():
+            day_type = day_schedule_map[day]
+            for section in grade.sections:
+                for time_slot in time_slots:
+                    var_name = f'G{grade.grade_number}_{day}_S{section}_T{time_slot}'
+                    variables.append(var_name)
+                    variable_keys[var_name] = (grade.grade_number, day, section, time_slot)
+                    domains[var_name] = [(subject, t.name) for subject in grade.subjects_day[day_type]
+                                         for t in qualified.get((grade.grade_number, subject), ())]
+    return variables, domains, variable_keys
+
+
+def precheck(grades, teacher_pool, day_schedule_map):
+    # None if the teachers can cover the week, otherwise the lines explaining what is missing
+    # finds how many times a particular subject needs to be scheduled for a given grade across all sections and days
+    required_assignments = count_required_assignments(grades, day_schedule_map)
+    qualified_teachers = qualification_index(teacher_pool)
+
+    # Check for missing teachers
+    missing_teachers = [pair for pair in required_assignments if pair not in qualified_teachers]
+    if missing_teachers:
+        lines = ["Scheduling Error: The following subjects cannot be scheduled due to a lack of teachers:"]
+        for grade_number, subject in missing_teachers:
+            lines.append(f"   - Grade {grade_number}: {subject}")
+        lines.extend(["", "Please assign teachers to these subjects to continue."])
+        return lines
+
+    # checks if the available teachers can handle the total workload, however the subjects share them
+    shortfall = capacity_shortfall(required_assignments, qualified_teachers)
+    if shortfall:
+        short_subjects, short_teachers = shortfall
+        needed = sum(required_assignments[pair] for pair in short_subjects)
+        lines = ["", "ATTENTION: Scheduling Issue Detected!",
+                 f"These subjects require {needed} assignments between them:"]
+        for g_num, subj in short_subjects:
+            lines.append(f" - Grade {g_num}, Subject '{subj}': {required_assignments[(g_num, subj)]} assignments")
+        capacity = sum(t.max_hours // 2 for t in short_teachers)
+        lines.append(f"but the only teachers qualified for them can handle {capacity}:")
+        for t in short_teachers:
+            lines.append(f" - '{t.name}': {t.max_hours // 2} assignments (max {t.max_hours} hours)")
+        lines.extend(["Please increase these teachers' max hours or add another qualified teacher for these subjects.",
+                      ""])
+        return lines
     return None
 
 
-def count_teacher_hours(assignment):
+def build_model(grades, teacher_pool, time_slots, day_schedule_map):
+    # Now we can start building the CSP, set variables and domains
+    variables, domains, variable_keys = build_domains(grades, day_schedule_map, time_slots,
+                                                      qualification_index(teacher_pool))
+    return ProblemModel(variables, domains, variable_keys, teacher_pool, time_slots)
+
+
+def _dense_id(ids, key):
+    return ids.setdefault(key, len(ids))
+
+
+class ProblemModel:
+    # Integer form of the CSP, compiled once after the domains are built. Every variable, teacher,
+    # subject, day and slot gets a dense id and the engine runs on those ids only; the names are
+    # kept for display and export.
+    def __init__(self, variables, domains, variable_keys, teacher_pool, time_slots):
+        self.teacher_pool = tuple(teacher_pool)
+        self.time_slots = dict(time_slots)
+        self.variable_names = tuple(variables)
+        self.variable_keys = tuple(variable_keys[var] for var in variables)  # (grade, day, section, time slot)
+        self.variable_ids = {var: i for i, var in enumerate(variables)}
+
+        teacher_ids = {t.name: i for i, t in enumerate(teacher_pool)}
+        teacher_max_hours = [t.max_hours for t in teacher_pool]
+        slot_ids = {key: i for i, key in enumerate(sorted(time_slots))}
+        day_ids, grade_ids, section_ids, class_day_ids = {}, {}, {}, {}
+        subject_ids, value_ids = {}, {}
+        value_subject, value_teacher = array('i'), array('i')
+
+        self.var_grade = array('i')
+        self.var_section = array('i')  # dense id of (grade, section)
+        self.var_day = array('i')
+        self.var_slot = array('i')
+        self.var_class_day = array('i')  # dense id of (grade, day, section)
+        domain_values = []
+        for var, (grade_number, day, section, time_slot) in zip(variables, self.variable_keys):
+            self.var_grade.append(_dense_id(grade_ids, grade_number))
+            self.var_section.append(_dense_id(section_ids, (grade_number, section)))
+            self.var_day.append(_dense_id(day_ids, day))
+            self.var_slot.append(slot_ids[time_slot])
+            self.var_class_day.append(_dense_id(class_day_ids, (grade_number, day, section)))
+            var_values = []
+            for subject, teacher in domains[var]:
+                if (subject, teacher) not in value_ids:
+                    if teacher not in teacher_ids:
+                        teacher_max_hours.append(-1)  # unknown teacher, rejected by constraint4
+                    value_subject.append(_dense_id(subject_ids, subject))
+                    value_teacher.append(_dense_id(teacher_ids, teacher))
+                var_values.append(_dense_id(value_ids, (subject, teacher)))
+            domain_values.append(tuple(var_values))
+        self.domains = tuple(domain_values)
+
+        self.teacher_names = tuple(teacher_ids)
+        self.teacher_max_hours = array('i', teacher_max_hours)
+        # bit masks over value ids: the values of each subject and of each teacher, and each domain
+        subject_values, teacher_values = [0] * len(subject_ids), [0] * len(teacher_ids)
+        for value, (subject, teacher) in enumerate(zip(value_subject, value_teacher)):
+            subject_values[subject] |= 1 << value
+            teacher_values[teacher] |= 1 << value
+        self.subject_values = tuple(subject_values)
+        self.teacher_values = tuple(teacher_values)
+        self.domain_masks = tuple(sum(1 << value for value in set(var_values)) for var_values in self.domains)
+        self.subject_names = tuple(subject_ids)
+        self.value_names = tuple(value_ids)  # value -> (subject, teacher)
+        self.value_subject = value_subject
+        self.value_teacher = value_teacher
+        self.day_names = tuple(day_ids)
+        self.grade_numbers = tuple(grade_ids)
+        self.slot_keys = tuple(slot_ids)
+        # slot -> the slots directly before and after it
+        self.adjacent_slots = tuple(
+            tuple(slot_ids[key + delta] for delta in (-1, 1) if key + delta in slot_ids) for key in self.slot_keys)
+        self.num_class_days = len(class_day_ids)
+        # dense ids of (day, slot) and (grade, day, slot), for the ScheduleIndex bitboards
+        day_slots = len(self.day_names) * len(self.slot_keys)
+        self.var_day_slot = array('i', (day * len(self.slot_keys) + slot
+                                        for day, slot in zip(self.var_day, self.var_slot)))
+        self.var_grade_slot = array('i', (grade * day_slots + day_slot
+                                          for grade, day_slot in zip(self.var_grade, self.var_day_slot)))
+        # teacher -> (grade, section) from Teacher.preferred_class, section -1 when any section of the
+        # grade will do and -2 for a class this model does not contain
+        self.teacher_preferred = tuple(self._preferred_class(t.preferred_class, grade_ids, section_ids)
+                                       for t in teacher_pool) + (None,) * (len(self.teacher_names) - len(teacher_pool))
+
+        # constraint neighbourhoods, used by forward checking and arc consistency
+        class_day_vars = [[] for _ in range(self.num_class_days)]
+        day_slot_vars = [[] for _ in range(len(self.day_names) * len(self.slot_keys))]
+        teacher_vars = [[] for _ in self.teacher_names]
+        for var, var_values in enumerate(self.domains):
+            class_day_vars[self.var_class_day[var]].append(var)
+            day_slot_vars[self.var_day[var] * len(self.slot_keys) + self.var_slot[var]].append(var)
+            for teacher in {self.value_teacher[value] for value in var_values}:
+                teacher_vars[teacher].append(var)
+        self.class_day_vars = tuple(tuple(group) for group in class_day_vars)  # same grade, day and section
+        self.day_slot_vars = tuple(tuple(group) for group in day_slot_vars)  # same day and slot
+        self.teacher_vars = tuple(tuple(group) for group in teacher_vars)  # teacher appears in the domain
+        # (grade, day, slot) of the slots directly before and after, with the var of the same section there
+        self.adjacent_own_vars = tuple(
+            tuple((self.var_grade_slot[var] - self.var_slot[var] + slot,
+                   next((other for other in self.class_day_vars[self.var_class_day[var]]
+                         if self.var_slot[other] == slot), -1))
+                  for slot in self.adjacent_slots[self.var_slot[var]])
+            for var in range(len(self.domains)))
+        # other sections of the same grade in the slots directly before and after (constraint3)
+        self.adjacent_vars = tuple(
+            tuple(other for slot in self.adjacent_slots[self.var_slot[var]]
+                  for other in self.day_slot_vars[self.var_day[var] * len(self.slot_keys) + slot]
+                  if self.var_grade[other] == self.var_grade[var] and self.var_section[other] != self.var_section[var])
+            for var in range(len(self.domains)))
+
+    def submodel(self, vars):
+        # the same school restricted to the given variables, compiled with its own dense ids
+        names = [self.variable_names[var] for var in vars]
+        domains = {name: [self.value_names[value] for value in self.domains[var]] for name, var in zip(names, vars)}
+        keys = {name: self.variable_keys[var] for name, var in zip(names, vars)}
+        return ProblemModel(names, domains, keys, self.teacher_pool, self.time_slots)
+
+    @staticmethod
+    def _preferred_class(preferred_class, grade_ids, section_ids):
+        if preferred_class is None:
+            return None
+        if isinstance(preferred_class, tuple):
+            grade_number, section = preferred_class
+            return grade_ids.get(grade_number, -2), section_ids.get((grade_number, section), -2)
+        return grade_ids.get(preferred_class, -2), -1
+
+    def busy_key(self, day, slot, teacher):
+        return (day * len(self.slot_keys) + slot) * len(self.teacher_names) + teacher
+
+    def placed_key(self, class_day, subject):
+        return class_day * len(self.subject_names) + subject
+
+
+def count_teacher_hours(model, solution):
     teacher_hours = {}
-    for var, (subject, teacher) in assignment.items():
-        teacher_hours[teacher] = teacher_hours.get(teacher, 0) + 2
+    for value in solution:
+        if value >= 0:
+            teacher = model.teacher_names[model.value_teacher[value]]
+            teacher_hours[teacher] = teacher_hours.get(teacher, 0) + 2
     return teacher_hours
 
 
-def constraint1(var, value, assignment, variables, domains):
-    subject, teacher = value
-    tokens = var.split('_')
-    grade_number = int(tokens[0][1])
-    day = tokens[1]
-    section = tokens[2][1]
-
-    for other_time_slot in time_slots:
-        other_var = f'G{grade_number}_{day}_S{section}_T{other_time_slot}'
-        if other_var in assignment and other_var != var:
-            assigned_subject, assigned_teacher = assignment[other_var]
-            if assigned_subject == subject:
-                return False, f"Constraint1 Violated: Duplicate subject '{subject}' in Grade {grade_number}, Day {day}, Section {section}."
-    return True, ""
-
-
-def constraint2(var, value, assignment, variables, domains):
-    subject, teacher = value
-    tokens = var.split('_')
-    day = tokens[1]
-    time_slot = int(tokens[3][1])
-
-    for v in assignment:
-        if v != var:
-            v_tokens = v.split('_')
-            v_day = v_tokens[1]
-            v_time_slot = int(v_tokens[3][1])
-            if v_day == day and v_time_slot == time_slot:
-                assigned_subject, assigned_teacher = assignment[v]
-                if assigned_teacher == teacher:
-                    return False, f"Constraint2 Violated: Teacher '{teacher}' assigned to multiple sections at the same time on {day}, Time Slot {time_slot}."
-    return True, ""
-
-
-def constraint3(var, value, assignment, variables, domains):
-    subject, teacher = value
-    tokens = var.split('_')
-    grade_number = int(tokens[0][1])
-    day = tokens[1]
-    section = tokens[2][1]
-    time_slot = int(tokens[3][1])
-
-    for delta in [-1, 1]:
-        adjacent_time_slot = time_slot + delta
-        if adjacent_time_slot not in time_slots:
-            continue
-        for other_section in [sec for sec in next(g.sections for g in grades if g.grade_number == grade_number) if
-                              sec != section]:
-            adj_var = f'G{grade_number}_{day}_S{other_section}_T{adjacent_time_slot}'
-            if adj_var in assignment:
-                adj_subject, adj_teacher = assignment[adj_var]
-                if adj_teacher == teacher:
-                    return False, f"Constraint3 Violated: Teacher '{teacher}' has back-to-back assignments in Grade {grade_number}, Day {day}."
-    return True, ""
+class ScheduleIndex:
+    # The partial assignment together with its occupancy and workload, kept in step by the engine
+    # so that each built-in constraint is a single array lookup instead of a scan.
+    def __init__(self, model):
+        self.model = model
+        self.values = [-1] * len(model.variable_names)  # var -> assigned value, -1 while unassigned
+        self.assigned = 0
+        self.teacher_hours = [0] * len(model.teacher_names)
+        # (day, slot, teacher) -> var holding that teacher, -1 if free
+        self.busy_teachers = [-1] * (len(model.day_names) * len(model.slot_keys) * len(model.teacher_names))
+        # (grade, day, section, subject) -> var teaching that subject, -1 if not placed yet
+        self.placed_subjects = [-1] * (model.num_class_days * len(model.subject_names))
+        # The same occupancy as bitboards over value ids, for blocked_values: (grade, day, section) ->
+        # values of the subjects placed, (day, slot) -> values of the busy teachers, (grade, day, slot)
+        # -> values of the teachers with a class of that grade, and the values of teachers without two
+        # hours to spare. Like the arrays above they assume constraint1 and constraint2 hold.
+        day_slots = len(model.day_names) * len(model.slot_keys)
+        self.placed_values = [0] * model.num_class_days
+        self.slot_values = [0] * day_slots
+        self.grade_slot_values = [0] * (len(model.grade_numbers) * day_slots)
+        self.full_values = 0
+        for teacher, max_hours in enumerate(model.teacher_max_hours):
+            if max_hours < 2:
+                self.full_values |= model.teacher_values[teacher]
+
+    def assign(self, var, value):
+        model = self.model
+        teacher = model.value_teacher[value]
+        self.values[var] = value
+        self.assigned += 1
+        self.teacher_hours[teacher] += 2
+        self.busy_teachers[model.busy_key(model.var_day[var], model.var_slot[var], teacher)] = var
+        self.placed_subjects[model.placed_key(model.var_class_day[var], model.value_subject[value])] = var
+        teacher_values = model.teacher_values[teacher]
+        day_slot = model.var_day_slot[var]
+        self.placed_values[model.var_class_day[var]] |= model.subject_values[model.value_subject[value]]
+        self.slot_values[day_slot] |= teacher_values
+        self.grade_slot_values[model.var_grade_slot[var]] |= teacher_values
+        if self.teacher_hours[teacher] + 2 > model.teacher_max_hours[teacher]:
+            self.full_values |= teacher_values
+
+    def unassign(self, var):
+        model = self.model
+        value = self.values[var]
+        teacher = model.value_teacher[value]
+        self.values[var] = -1
+        self.assigned -= 1
+        self.teacher_hours[teacher] -= 2
+        self.busy_teachers[model.busy_key(model.var_day[var], model.var_slot[var], teacher)] = -1
+        self.placed_subjects[model.placed_key(model.var_class_day[var], model.value_subject[value])] = -1
+        teacher_values = ~model.teacher_values[teacher]
+        self.placed_values[model.var_class_day[var]] &= ~model.subject_values[model.value_subject[value]]
+        self.slot_values[model.var_day_slot[var]] &= teacher_values
+        self.grade_slot_values[model.var_grade_slot[var]] &= teacher_values
+        if self.teacher_hours[teacher] + 2 <= model.teacher_max_hours[teacher]:
+            self.full_values &= teacher_values
+
+    def blocked_values(self, var):
+        # masks of the values that constraint1, constraint2, constraint3 and constraint4 rule out for the
+        # unassigned var
+        model, values = self.model, self.values
+        adjacent = 0
+        for grade_slot, own in model.adjacent_own_vars[var]:
+            teachers = self.grade_slot_values[grade_slot]
+            if own >= 0 and values[own] >= 0:
+                teachers &= ~model.teacher_values[model.value_teacher[values[own]]]  # its own section is fine
+            adjacent |= teachers
+        return self.placed_values[model.var_class_day[var]], self.slot_values[model.var_day_slot[var]], adjacent, \
+            self.full_values
+
+    def teacher_assignments(self, teacher):
+        busy, num_teachers = self.busy_teachers, len(self.model.teacher_names)
+        return tuple(busy[key] for key in range(teacher, len(busy), num_teachers) if busy[key] >= 0)
+
+
+def constraint1(var, value, index):
+    model = index.model
+    subject = model.value_subject[value]
+
+    other_var = index.placed_subjects[model.placed_key(model.var_class_day[var], subject)]
+    if other_var >= 0 and other_var != var:
+        return False, (other_var,)
+    return True, ()
+
+
+def constraint2(var, value, index):
+    model = index.model
+    teacher = model.value_teacher[value]
+
+    other_var = index.busy_teachers[model.busy_key(model.var_day[var], model.var_slot[var], teacher)]
+    if other_var >= 0 and other_var != var:
+        return False, (other_var,)
+    return True, ()
+
+
+def constraint3(var, value, index):
+    model = index.model
+    teacher = model.value_teacher[value]
+    day = model.var_day[var]
+
+    for adjacent_slot in model.adjacent_slots[model.var_slot[var]]:
+        # a teacher holds at most one class per slot, so the busy index gives the only candidate
+        adj_var = index.busy_teachers[model.busy_key(day, adjacent_slot, teacher)]
+        if adj_var >= 0 and model.var_grade[adj_var] == model.var_grade[var] and \
+                model.var_section[adj_var] != model.var_section[var]:
+            return False, (adj_var,)
+    return True, ()
 
 
 # Check for max hours
-def constraint4(var, value, assignment, variables, domains):
-    subject, teacher = value
-    current_hours = count_teacher_hours(assignment)
-    new_hours = current_hours.get(teacher, 0) + 2
-    t_obj = get_teacher_by_name(teacher)
-    if t_obj is None:
-        return False, f"Unknown teacher '{teacher}'"
-    if new_hours > t_obj.max_hours:
-        return False, f"Max Hours Constraint Violated: Teacher '{teacher}' exceeded max hours ({t_obj.max_hours})."
-    return True, ""
+def constraint4(var, value, index):
+    model = index.model
+    teacher = model.value_teacher[value]
+    max_hours = model.teacher_max_hours[teacher]
+    if max_hours < 0:
+        return False, ()
+    if index.teacher_hours[teacher] + 2 > max_hours:
+        return False, index.teacher_assignments(teacher)
+    return True, ()
 
 
 constraints = [constraint1, constraint2, constraint3, constraint4]
+builtin_constraints = tuple(constraints)  # the ones CSPEngine can check with ScheduleIndex bitboards
+
+# Outcomes of CSPEngine.resume
+SOLVED = 'solved'
+FAILED = 'failed'
+PAUSED = 'paused'
+
+
+def luby(i):
+    # i-th term of the Luby restart sequence 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, ...
+    k = 1
+    while (1 << k) - 1 < i:
+        k += 1
+    if (1 << k) - 1 == i:
+        return 1 << (k - 1)
+    return luby(i - (1 << (k - 1)) + 1)
+
+# Report wording for each kind of conflict, filled in only when the report is printed
+conflict_messages = {
+    'constraint1': "Constraint1 Violated: Duplicate subject '{subject}' in Grade {grade}.",
+    'constraint2': "Constraint2 Violated: Teacher '{teacher}' assigned to multiple sections at the same time in Grade {grade}.",
+    'constraint3': "Constraint3 Violated: Teacher '{teacher}' has back-to-back assignments in Grade {grade}.",
+    'constraint4': "Max Hours Constraint Violated: Teacher '{teacher}' exceeded max hours ({max_hours}).",
+    'forward_check': "Forward Check Failed: Giving '{subject}' to Teacher '{teacher}' leaves a Grade {grade} class with no subject or teacher.",
+    'arc_consistency': "Arc Consistency Failed: A Grade {grade} class has no subject or teacher that fits.",
+}
+
+
+class ConflictLog:
+    # Conflicts counted by (reason, teacher, grade, subject) as the search runs, so memory stays flat
+    # however long it takes; messages are only built when the report asks for them. An optional ring
+    # buffer keeps the most recent raw (reason, var, value) conflicts.
+    def __init__(self, model, recent=0):
+        self.model = model
+        self.counts = Counter()  # (reason, teacher, grade, subject) -> occurrences, -1 where not applicable
+        self.recent = deque(maxlen=recent) if recent else None
+
+    def __len__(self):
+        return sum(self.counts.values())
+
+    def record(self, reason, var, value=-1):
+        model = self.model
+        if value >= 0:
+            key = (reason, model.value_teacher[value], model.var_grade[var], model.value_subject[value])
+        else:
+            key = (reason, -1, model.var_grade[var], -1)
+        self.counts[key] += 1
+        if self.recent is not None:
+            self.recent.append((reason, var, value))
+
+    def entries(self):
+        # (reason, teacher, grade number, subject, count) with the names filled in
+        model = self.model
+        for (reason, teacher, grade, subject), count in self.counts.items():
+            yield (reason, model.teacher_names[teacher] if teacher >= 0 else None, model.grade_numbers[grade],
+                   model.subject_names[subject] if subject >= 0 else None, count)
+
+    def describe(self, reason, teacher, grade, subject):
+        model = self.model
+        max_hours = model.teacher_max_hours[model.teacher_names.index(teacher)] if teacher is not None else None
+        if reason == 'constraint4' and max_hours < 0:
+            return f"Unknown teacher '{teacher}'"
+        template = conflict_messages.get(reason, "{reason} Violated: Teacher '{teacher}', Subject '{subject}' in Grade {grade}.")
+        return template.format(reason=reason, teacher=teacher, grade=grade, subject=subject, max_hours=max_hours)
+
+    def merge(self, other):
+        # adds the counts of a log kept over another model of the same school, such as a submodel
+        self.add_entries(other.entries())
+
+    def add_entries(self, entries):
+        # adds (reason, teacher, grade number, subject, count) entries as produced by entries()
+        model = self.model
+        teacher_ids = {name: i for i, name in enumerate(model.teacher_names)}
+        grade_ids = {number: i for i, number in enumerate(model.grade_numbers)}
+        subject_ids = {name: i for i, name in enumerate(model.subject_names)}
+        for reason, teacher, grade_number, subject, count in entries:
+            key = (reason, teacher_ids[teacher] if teacher is not None else -1, grade_ids[grade_number],
+                   subject_ids[subject] if subject is not None else -1)
+            self.counts[key] += count
+
+    def summary(self):
+        # message -> occurrences, in the order the conflicts first came up
+        messages = {}
+        for reason, teacher, grade, subject, count in self.entries():
+            message = self.describe(reason, teacher, grade, subject)
+            messages[message] = messages.get(message, 0) + count
+        return messages
+
+
+class NogoodStore:
+    # Learned dead ends: sets of (var, value) pairs that cannot all hold in any solution. Each nogood
+    # counts how many of its pairs the current assignment does not satisfy yet, kept in step by the
+    # engine, so matching is a counter comparison. The store is bounded; the least recently used nogood is
+    # evicted once it is full.
+    def __init__(self, capacity=2000, max_size=8):
+        self.capacity = capacity
+        self.max_size = max_size  # longer conflict sets rarely match again and are not kept
+        self.nogoods = OrderedDict()  # frozenset of (var, value) -> pairs not satisfied, least recently used first
+        self.watches = {}  # (var, value) -> nogoods containing that pair
+
+    def __len__(self):
+        return len(self.nogoods)
+
+    def add(self, pairs, values=None):
+        # pairs are all satisfied by the assignment at the time they are learned, unless the current
+        # values are given to count the ones that are not (the image of a nogood under a symmetry)
+        nogood = frozenset(pairs)
+        if not nogood or len(nogood) > self.max_size or self.capacity <= 0:
+            return False
+        if nogood in self.nogoods:
+            self.nogoods.move_to_end(nogood)
+            return False
+        if len(self.nogoods) >= self.capacity:
+            evicted, _ = self.nogoods.popitem(last=False)
+            for pair in evicted:
+                self.watches[pair].discard(evicted)
+        self.nogoods[nogood] = 0 if values is None else sum(values[var] != value for var, value in nogood)
+        for pair in nogood:
+            self.watches.setdefault(pair, set()).add(nogood)
+        return True
+
+    def assign(self, var, value):
+        nogoods = self.nogoods
+        for nogood in self.watches.get((var, value), ()):
+            nogoods[nogood] -= 1
+
+    def unassign(self, var, value):
+        nogoods = self.nogoods
+        for nogood in self.watches.get((var, value), ()):
+            nogoods[nogood] += 1
+
+    def match(self, var, value):
+        # the other variables of a nogood that var = value would complete, or None
+        nogoods = self.nogoods
+        for nogood in self.watches.get((var, value), ()):
+            if nogoods[nogood] == 1:
+                nogoods.move_to_end(nogood)
+                return tuple(other for other, _ in nogood if other != var)
+        return None
+
+
+def find_symmetries(model):
+    # Interchangeable parts of the school. Sections of a grade with the same days, slots and domains can
+    # swap their whole week, and teachers found in exactly the same domains with the same max_hours can
+    # swap all their classes; either way a timetable stays a timetable. Returns (section classes,
+    # teacher classes) with at least two members each: a section is the tuple of its variables in
+    # (day, slot) order, so equal positions correspond, and teachers are dense ids.
+    section_vars = {}
+    for var in range(len(model.domains)):
+        section_vars.setdefault(model.var_section[var], []).append(var)
+    groups = {}
+    for section in sorted(section_vars):
+        vars = sorted(section_vars[section], key=lambda var: (model.var_day[var], model.var_slot[var]))
+        signature = (model.var_grade[vars[0]],) + tuple(
+            (model.var_day[var], model.var_slot[var], model.domains[var]) for var in vars)
+        groups.setdefault(signature, []).append(tuple(vars))
+    section_classes = tuple(tuple(group) for group in groups.values() if len(group) > 1)
+
+    appearances = [[] for _ in model.teacher_names]
+    for var, domain in enumerate(model.domains):
+        for value in domain:
+            appearances[model.value_teacher[value]].append((var, model.value_subject[value]))
+    groups = {}
+    for teacher, seen in enumerate(appearances):
+        if seen and model.teacher_max_hours[teacher] >= 0:
+            groups.setdefault((model.teacher_max_hours[teacher], tuple(sorted(seen))), []).append(teacher)
+    teacher_classes = tuple(tuple(group) for group in groups.values() if len(group) > 1)
+    return section_classes, teacher_classes
+
+
+class ConstraintProfile:
+    # A constraint that counts its checks and rejections and the time spent in it
+    def __init__(self, constraint):
+        self.constraint = constraint
+        self.__name__ = constraint.__name__
+        self.checks = 0
+        self.rejections = 0
+        self.time = 0.0
+
+    def __call__(self, var, value, index):
+        start = time.perf_counter()
+        result = self.constraint(var, value, index)
+        self.time += time.perf_counter() - start
+        self.checks += 1
+        if not result[0]:
+            self.rejections += 1
+        return result
 
 
 class CSPEngine:
-    def __init__(self, variables, domains, constraints):
-        self.variables = variables
-        self.domains = domains
+    def __init__(self, model, constraints, forward_checking=False, arc_consistency=False, backjumping=False,
+                 nogood_capacity=2000, recent_conflicts=0, seed=None, value_order='static', restarts=None,
+                 restart_base=100, initial=None, hints=None, profile=False, progress=None, progress_every=1000,
+                 symmetry=None):
+        self.model = model
+        self.variables = range(len(model.variable_names))
+        self.domains = model.domains
         self.constraints = constraints
-        self.conflict_log = []
+        self.forward_checking = forward_checking  # prune neighbouring domains after each assignment
+        self.arc_consistency = arc_consistency  # run AC-3 over the initial domains before searching
+        self.backjumping = backjumping  # jump back to the most recent culprit of a dead end
+        self.nogoods = NogoodStore(nogood_capacity) if backjumping else None
+        self.random = random.Random(seed) if seed is not None else None  # breaks MRV and value ordering ties
+        self.value_order = value_order  # 'static', 'random', 'lcv' or 'least_loaded'
+        self.restarts = restarts  # None, 'luby' or 'geometric'
+        self.restart_base = restart_base  # nodes before the first restart
+        self.initial = initial  # values fixed before the search starts, -1 for classes it should fill
+        self.hints = hints  # values to try first, -1 for none, e.g. an earlier timetable
+        self._initial_mark = None  # trail length before the initial values, see release
+        self.stats = {'nodes': 0, 'backtracks': 0, 'backjumps': 0, 'nogoods_learned': 0, 'nogood_hits': 0,
+                      'restarts': 0, 'max_depth': 0, 'time': 0.0}
+        # profiling counts and times every constraint check and variable selection, see constraint_stats
+        self.profile = profile
+        self._checks = [ConstraintProfile(constraint) for constraint in constraints] if profile else constraints
+        # With all four built-in constraints, ScheduleIndex.blocked_values tells which of them a candidate
+        # fails, so only those and the other constraints are called. Profiling counts every check and
+        # turns this off.
+        self._blocked_filter = not profile and all(check in constraints for check in builtin_constraints)
+        self._check_boards = [(check, builtin_constraints.index(check) + 1 if check in builtin_constraints else 5)
+                              for check in constraints]  # position of the mask in _blocked(var)
+        self._other_checks = [constraint for constraint in constraints if constraint not in builtin_constraints]
+        if profile:
+            self.stats['select_time'] = 0.0
+            self.stats['forward_check_time'] = 0.0
+        # progress(engine) is called every progress_every nodes, and may call engine.pause()
+        self.progress = progress
+        self.progress_every = progress_every
+        self._next_progress = progress_every if progress is not None else math.inf
+        self.index = ScheduleIndex(model)
+        self.conflict_log = ConflictLog(model, recent_conflicts)
+        # live domains as bit masks over value ids, and var -> {var whose assignment pruned values, -1 for
+        # preprocessing: mask of those values}
+        self.live = list(model.domain_masks)
+        self.pruned = [{} for _ in self.variables]
+        self.live_size = [bin(mask).count('1') for mask in self.live]
+        self._trail = []  # (var, culprit, mask, count) prunings in the order they were made
+        self._queue = []  # (live domain size, rank) heap, entries go stale as sizes change
+        self._rank = list(self.variables)  # var -> MRV tie-break rank
+        self._ranked = list(self.variables)  # rank -> var
+        if self.random is not None:
+            self._shuffle_ranks()
+        self._restart_limit = None  # node count at which the search starts over
+        self._depth = [-1] * len(self.variables)  # var -> position in the assignment order
+        self._conf_set = [set() for _ in self.variables]  # var -> earlier vars that ruled out its values
+        self._jump_to = None  # var the search is unwinding to after a dead end, -1 for the root
+        self._stack = []  # choice points, see _backtrack
+        self._descend = True  # pick a new variable next, rather than retry the top choice point
+        self._started = False
+        self._status = PAUSED
+        self._pause_requested = False
+        self._deadline = None  # perf_counter time at which anytime_search stops
+        self._next_clock_check = 0
+        self._best = None  # deepest assignment reached, kept while anytime_search runs
+        # symmetry breaking: None, 'infeasibility' to only skip branches that mirror ones already failed
+        # (the first timetable found does not change), or 'solutions' to also order interchangeable sections
+        self.symmetry = symmetry
+        self._symmetric_values = None  # value -> the same subject with each interchangeable teacher
+        self._section_order = None  # first var of a section -> first vars of its neighbours in the order
+        self._section_key = None  # value -> subject and teacher class, compared by the section order
+        self._generators = ()  # (var map, value map) symmetries whose images of learned nogoods are kept
+        if symmetry is not None:
+            self._find_symmetries()
+
+    def _find_symmetries(self):
+        model = self.model
+        section_classes, teacher_classes = find_symmetries(model)
+        self.stats['symmetric_skips'] = 0
+        value_ids = {(subject, teacher): value
+                     for value, (subject, teacher) in enumerate(zip(model.value_subject, model.value_teacher))}
+        teacher_class = list(range(len(model.teacher_names)))
+        generators = []
+        self._symmetric_values = {}
+        for group in teacher_classes:
+            for teacher in group:
+                teacher_class[teacher] = group[0]
+            for value, (subject, teacher) in enumerate(zip(model.value_subject, model.value_teacher)):
+                if teacher in group:
+                    self._symmetric_values[value] = tuple(
+                        value_ids[subject, other] for other in group if other != teacher and (subject, other) in value_ids)
+            for first, second in zip(group, group[1:]):
+                swap = {}
+                for (subject, teacher), value in value_ids.items():
+                    other = second if teacher == first else first if teacher == second else None
+                    if other is not None and (subject, other) in value_ids:
+                        swap[value] = value_ids[subject, other]
+                generators.append(({}, swap))
+
+        # Swapping sections mirrors every branch of the search, so sections are either put in order
+        # ('solutions', lex-leader on their first class: never both ways round) or learned dead ends are
+        # copied to the other sections ('infeasibility'). Fixed initial values break the symmetry.
+        if self.initial is None:
+            for sections in section_classes:
+                if self.symmetry == 'solutions':
+                    leaders = [vars[0] for vars in sections]
+                    if self._section_order is None:
+                        self._section_order = {}
+                        self._section_key = array('i', (
+                            subject * len(teacher_class) + teacher_class[teacher]
+                            for subject, teacher in zip(model.value_subject, model.value_teacher)))
+                    for i, leader in enumerate(leaders):
+                        self._section_order[leader] = (leaders[i - 1] if i > 0 else -1,
+                                                       leaders[i + 1] if i + 1 < len(leaders) else -1)
+                else:
+                    for first, second in zip(sections, sections[1:]):
+                        swap = dict(zip(first, second))
+                        swap.update(zip(second, first))
+                        generators.append((swap, {}))
+        if self.nogoods is not None:
+            self._generators = tuple(generators)
 
-    def is_consistent(self, var, value, assignment):
-        conflict_messages = []
-        for constraint in self.constraints:
-            result, message = constraint(var, value, assignment, self.variables, self.domains)
+    def is_consistent(self, var, value):
+        return self.find_culprits(var, value) is None
+
+    def find_culprits(self, var, value):
+        # None if var = value is consistent, otherwise the assigned variables it clashes with
+        return self._culprits(var, value, self._checks)
+
+    def _culprits(self, var, value, checks):
+        culprits = None
+        for constraint in checks:
+            result, constraint_culprits = constraint(var, value, self.index)
             if not result:
-                conflict_messages.append(message)
-        if conflict_messages:
-            self.conflict_log.append((var, value, conflict_messages))
-            return False
+                self.conflict_log.record(constraint.__name__, var, value)
+                if culprits is None:
+                    culprits = set()
+                culprits.update(constraint_culprits)
+        if self._section_order is not None and var in self._section_order:
+            values, key = self.index.values, self._section_key
+            before, after = self._section_order[var]
+            if before >= 0 and values[before] >= 0 and key[values[before]] > key[value]:
+                culprits = {before}
+            if after >= 0 and values[after] >= 0 and key[value] > key[values[after]]:
+                culprits = (culprits or set()) | {after}
+        if culprits is not None:
+            return culprits
+        if self.nogoods:
+            nogood_culprits = self.nogoods.match(var, value)
+            if nogood_culprits is not None:
+                self.stats['nogood_hits'] += 1
+                return set(nogood_culprits)
+        return None
+
+    def select_unassigned_variable(self):
+        # MRV heuristic: smallest live domain first, ties broken by rank (variable order unless seeded)
+        values, live_size, queue, ranked = self.index.values, self.live_size, self._queue, self._ranked
+        while queue:
+            size, rank = heappop(queue)
+            var = ranked[rank]
+            if values[var] < 0 and size == live_size[var]:
+                return var
+        return None
+
+    def order_domain_values(self, var):
+        live = self.live[var]
+        if self.value_order == 'static' or self.live_size[var] < 2:
+            if live == self.model.domain_masks[var] and self.hints is None:
+                return self.domains[var]
+            candidates = [value for value in self.domains[var] if live >> value & 1]
+        else:
+            candidates = [value for value in self.domains[var] if live >> value & 1]
+            if self.random is not None:
+                self.random.shuffle(candidates)  # the sorts below are stable, so ties stay shuffled
+            if self.value_order == 'lcv':
+                candidates.sort(key=self._constraining_counts(var))
+            elif self.value_order == 'least_loaded':
+                model, hours = self.model, self.index.teacher_hours
+                candidates.sort(key=lambda value: hours[model.value_teacher[value]] /
+                                max(model.teacher_max_hours[model.value_teacher[value]], 1))
+        if self.hints is not None and self.hints[var] in candidates:
+            candidates.remove(self.hints[var])
+            candidates.insert(0, self.hints[var])
+        return candidates
+
+    def _constraining_counts(self, var):
+        # least-constraining value: how many live values of unassigned neighbours each value would rule out
+        values, domains, live = self.index.values, self.domains, self.live
+        tallies = []
+        for peers, attribute, _, _ in self._neighbourhoods(var, None):
+            tally = Counter(attribute[candidate] for other in peers if other != var and values[other] < 0
+                            for candidate in domains[other] if live[other] >> candidate & 1)
+            tallies.append((attribute, tally))
+        return lambda value: sum(tally[attribute[value]] for attribute, tally in tallies)
+
+    def _shuffle_ranks(self):
+        self.random.shuffle(self._ranked)
+        for rank, var in enumerate(self._ranked):
+            self._rank[var] = rank
+
+    def _rebuild_queue(self):
+        values, live_size, rank = self.index.values, self.live_size, self._rank
+        self._queue = [(live_size[v], rank[v]) for v in self.variables if values[v] < 0]
+        heapify(self._queue)
+
+    def _requeue(self, var):
+        if len(self._queue) > 8 * len(self.variables):
+            self._rebuild_queue()
+        heappush(self._queue, (self.live_size[var], self._rank[var]))
+
+    def _prune(self, var, mask, culprit):
+        # mask: live values of var to remove
+        count = bin(mask).count('1')
+        pruned = self.pruned[var]
+        pruned[culprit] = pruned.get(culprit, 0) | mask
+        self.live[var] ^= mask
+        self.live_size[var] -= count
+        self._trail.append((var, culprit, mask, count))
+
+    def _restore(self, mark):
+        trail, live, pruned, live_size = self._trail, self.live, self.pruned, self.live_size
+        touched = set()
+        while len(trail) > mark:
+            var, culprit, mask, count = trail.pop()
+            live[var] |= mask
+            remaining = pruned[var][culprit] ^ mask
+            if remaining:
+                pruned[var][culprit] = remaining
+            else:
+                del pruned[var][culprit]
+            live_size[var] += count
+            touched.add(var)
+        for var in touched:
+            self._requeue(var)
+
+    def _neighbourhoods(self, var, teacher):
+        # (peers, value attribute, attribute -> mask of its values, clashes with) for each active built-in
+        # constraint linking var to other variables
+        model = self.model
+        if constraint1 in self.constraints:
+            yield model.class_day_vars[model.var_class_day[var]], model.value_subject, model.subject_values, None
+        if constraint2 in self.constraints:
+            yield model.day_slot_vars[model.var_day[var] * len(model.slot_keys) + model.var_slot[var]], \
+                model.value_teacher, model.teacher_values, None
+        if constraint3 in self.constraints:
+            yield model.adjacent_vars[var], model.value_teacher, model.teacher_values, None
+        if constraint4 in self.constraints and teacher is not None and \
+                self.index.teacher_hours[teacher] + 2 > model.teacher_max_hours[teacher]:
+            yield model.teacher_vars[teacher], model.value_teacher, model.teacher_values, teacher
+
+    def _forward_check(self, var, value):
+        # remove values that now clash with var = value; on a domain wipeout, returns the
+        # variables whose assignments emptied it, otherwise None
+        model, values, live = self.model, self.index.values, self.live
+        teacher = model.value_teacher[value]
+        for peers, attribute, masks, target in self._neighbourhoods(var, teacher):
+            clashes = masks[attribute[value] if target is None else target]
+            for other in peers:
+                if values[other] >= 0:
+                    continue
+                removed = live[other] & clashes
+                if not removed:
+                    continue
+                self._prune(other, removed, var)
+                if self.live_size[other] == 0:
+                    self.conflict_log.record('forward_check', other, value)
+                    return {culprit for culprit in self.pruned[other] if culprit >= 0}
+                self._requeue(other)
+        return None
+
+    def make_arc_consistent(self):
+        # AC-3 over the binary "not the same subject / not the same teacher" constraints
+        model, live = self.model, self.live
+        if constraint4 in self.constraints:
+            full = 0
+            for teacher, max_hours in enumerate(model.teacher_max_hours):
+                if max_hours < 2:
+                    full |= model.teacher_values[teacher]
+            for var in self.variables:
+                if live[var] & full:
+                    self._prune(var, live[var] & full, -1)
+                if self.live_size[var] == 0:
+                    self.conflict_log.record('arc_consistency', var)
+                    return False
+        arcs = {var: [(other, attribute, masks) for peers, attribute, masks, _ in self._neighbourhoods(var, None)
+                      for other in peers if other != var] for var in self.variables}
+        queue = deque((var, other, attribute, masks) for var in self.variables for other, attribute, masks in arcs[var])
+        queued = {(var, other) for var, other, _, _ in queue}
+        while queue:
+            var, other, attribute, masks = queue.popleft()
+            queued.discard((var, other))
+            # a value of var loses its support only if every live value of other shares its attribute
+            if not live[other]:
+                continue
+            target = masks[attribute[(live[other] & -live[other]).bit_length() - 1]]
+            if live[other] & ~target:
+                continue
+            removed = live[var] & target
+            if not removed:
+                continue
+            self._prune(var, removed, -1)
+            if self.live_size[var] == 0:
+                self.conflict_log.record('arc_consistency', var)
+                return False
+            for neighbour, neighbour_attribute, neighbour_masks in arcs[var]:
+                if neighbour != other and (neighbour, var) not in queued:
+                    queue.append((neighbour, var, neighbour_attribute, neighbour_masks))
+                    queued.add((neighbour, var))
         return True
 
-    def select_unassigned_variable(self, assignment):
-        unassigned_vars = [v for v in self.variables if v not in assignment]
-        if not unassigned_vars:
+    def backtracking_search(self):
+        # runs the search to the end; returns (None, None) only if pause() stopped it first
+        status = self.resume()
+        if status == SOLVED:
+            return list(self.index.values), None
+        if status == FAILED:
+            return None, self.conflict_log
+        return None, None
+
+    def solve(self):
+        return self.backtracking_search()
+
+    def anytime_search(self, time_limit=None, max_nodes=None):
+        # Searches for at most time_limit seconds and max_nodes nodes, or until pause() is called from
+        # another thread, and settles for the most complete timetable it got to if it has to stop (or
+        # finds there is none). Returns (status, values, unfilled): values is -1 for the classes left
+        # empty, and unfilled maps their names to why nothing fits them next to the classes filled.
+        self._best = list(self.index.values)
+        self._deadline = None if time_limit is None else time.perf_counter() + time_limit
+        try:
+            status = self.resume(max_nodes)
+        finally:
+            self._deadline = None
+        if status == SOLVED:
+            self._best = None
+            return status, list(self.index.values), {}
+        best, self._best = self._best, None
+        values, unfilled = self._complete_greedily(best)
+        return status, values, unfilled
+
+    def _complete_greedily(self, best):
+        # fills what it can of the classes the search left empty, then explains the rest
+        model, constraints = self.model, self.constraints
+        index = ScheduleIndex(model)
+        for var, value in enumerate(best):
+            if value >= 0:
+                index.assign(var, value)
+        unfilled = {}
+        for var, value in enumerate(best):
+            if value >= 0:
+                continue
+            reasons = ConflictLog(model)
+            for value in self.domains[var]:
+                failed = [constraint.__name__ for constraint in constraints if not constraint(var, value, index)[0]]
+                if not failed:
+                    index.assign(var, value)
+                    break
+                for reason in failed:
+                    reasons.record(reason, var, value)
+            else:
+                if not self.domains[var]:
+                    reasons.record('arc_consistency', var)
+                unfilled[model.variable_names[var]] = list(reasons.summary())
+        return list(index.values), unfilled
+
+    def solutions(self, max_count=None, min_distance=0, distinct=False):
+        # Yields timetables one at a time as the search finds them, at most max_count of them. Each is
+        # the engine's own assignment list, valid until the next one is asked for: copy what you keep.
+        # min_distance skips a timetable that differs from one already yielded in fewer classes, and
+        # distinct skips mirror images (sections or teachers swapped, see find_symmetries) of one
+        # already yielded. Engines built with symmetry prune some mirror images during the search.
+        # Restarts would find the same timetables again and are switched off, and so is backjumping: a
+        # jump, and the nogood learned with it, would pass over choice points with timetables still below
+        # them, so the search goes on chronologically (nogoods learned before the first one still hold).
+        self.restarts, self._restart_limit, self.backjumping = None, None, False
+        kept = []  # yielded timetables, only for min_distance
+        seen = set()  # digests of the canonical forms yielded, only for distinct
+        canonical = self._canonical_form() if distinct else None
+        count = 0
+        while max_count is None or count < max_count:
+            if self.resume() != SOLVED:
+                return
+            values = self.index.values
+            accept = all(sum(a != b for a, b in zip(values, other)) >= min_distance for other in kept)
+            if accept and canonical is not None:
+                digest = hashlib.blake2b(canonical(values).tobytes(), digest_size=16).digest()
+                accept = digest not in seen
+                seen.add(digest)
+            if accept:
+                if min_distance:
+                    kept.append(array('i', values))
+                count += 1
+                yield values
+            self._next_solution()
+
+    def _next_solution(self):
+        # treats the timetable just found as a dead end that every assigned variable is to blame for,
+        # so that the search goes on chronologically from the last choice point
+        if not self._stack:
+            self._status = FAILED
+            return
+        frame = self._stack[-1]
+        self._undo(frame)
+        self.stats['backtracks'] += 1
+        self._conf_set[frame[0]].update(other[0] for other in self._stack[:-1])
+        self._descend = False
+        self._status = PAUSED
+
+    def _canonical_form(self):
+        # canonical(values): the mirror image shared by all timetables that only differ by swapping
+        # interchangeable sections or teachers, up to ties between sections with the same subjects
+        # and teacher classes. Sections are sorted by those, then the teachers of each class are
+        # renumbered in order of first appearance.
+        model = self.model
+        section_classes, teacher_classes = find_symmetries(model)
+        teacher_group = {teacher: group for group in teacher_classes for teacher in group}
+        value_ids = {(subject, teacher): value
+                     for value, (subject, teacher) in enumerate(zip(model.value_subject, model.value_teacher))}
+        collapsed = [(subject, teacher_group[teacher][0] if teacher in teacher_group else teacher)
+                     for subject, teacher in zip(model.value_subject, model.value_teacher)]
+
+        def canonical(values):
+            read = list(range(len(values)))
+            for sections in section_classes:
+                ordered = sorted(sections, key=lambda vars: [collapsed[values[var]] for var in vars])
+                for section, image in zip(sections, ordered):
+                    for var, other in zip(section, image):
+                        read[var] = other
+            renamed = {}
+            used = Counter()
+            form = array('i')
+            for var in read:
+                value = values[var]
+                teacher = model.value_teacher[value]
+                group = teacher_group.get(teacher)
+                if group is not None:
+                    if teacher not in renamed:
+                        renamed[teacher] = group[used[group]]
+                        used[group] += 1
+                    value = value_ids[model.value_subject[value], renamed[teacher]]
+                form.append(value)
+            return form
+        return canonical
+
+    def resume(self, max_nodes=None):
+        # continues the search where it stopped, for at most max_nodes more assignments
+        if not self._started:
+            self._started = True
+            if self.arc_consistency and not self.make_arc_consistent():
+                self._status = FAILED
+            if self.initial is not None and self._status == PAUSED:
+                self._initial_mark = len(self._trail)
+                self._assign_initial()
+            self._rebuild_queue()
+            if self.restarts is not None:
+                self._restart_limit = self.restart_base
+        if self._status == PAUSED:
+            self._pause_requested = False
+            self._resumed = (time.perf_counter(), self.stats['time'])
+            self._status = self._backtrack(max_nodes)
+            self._update_time()
+        return self._status
+
+    def _update_time(self):
+        start, time_before = self._resumed
+        self.stats['time'] = time_before + time.perf_counter() - start
+
+    def constraint_stats(self):
+        # constraint name -> checks, rejections and seconds spent in it; empty unless profiling
+        if not self.profile:
+            return {}
+        return {check.__name__: {'checks': check.checks, 'rejections': check.rejections, 'time': check.time}
+                for check in self._checks}
+
+    def _assign_initial(self):
+        for var, value in enumerate(self.initial):
+            if value >= 0:
+                self.index.assign(var, value)
+                if self.nogoods is not None:
+                    self.nogoods.assign(var, value)
+        if self.forward_checking and not self._forward_check_initial():
+            self._status = FAILED
+
+    def _forward_check_initial(self):
+        # Forward checking of the fixed values, done from the classes left to fill so that it costs as
+        # much as there is left to solve rather than as much as is fixed. Every pruning is put down to the
+        # same fixed class as when each of them is forward checked in turn. False on a domain wipeout.
+        model, values, live = self.model, self.index.values, self.live
+        filled, full = {}, 0  # teacher without two hours to spare -> first fixed class they teach
+        if constraint4 in self.constraints:
+            hours = self.index.teacher_hours
+            for var, value in enumerate(self.initial):
+                teacher = model.value_teacher[value] if value >= 0 else -1
+                if teacher >= 0 and teacher not in filled and hours[teacher] + 2 > model.teacher_max_hours[teacher]:
+                    filled[teacher] = var
+                    full |= model.teacher_values[teacher]
+        for var in self.variables:
+            if values[var] >= 0:
+                continue
+            prunings = [(other, masks[attribute[values[other]]])
+                        for peers, attribute, masks, _ in self._neighbourhoods(var, None)
+                        for other in peers if values[other] >= 0]
+            hits = live[var] & full
+            if hits:
+                teachers = {model.value_teacher[value] for value in self.domains[var] if hits >> value & 1}
+                prunings.extend((filled[teacher], model.teacher_values[teacher]) for teacher in teachers)
+            prunings.sort(key=lambda pruning: pruning[0])
+            for other, clashes in prunings:
+                removed = live[var] & clashes
+                if removed:
+                    self._prune(var, removed, other)
+                    if self.live_size[var] == 0:
+                        self.conflict_log.record('forward_check', var, values[other])
+                        return False
+        return True
+
+    def release(self, vars):
+        # Frees the fixed initial values of vars and takes the search back to the root to fill those
+        # classes too. Learned nogoods name the fixed classes they depend on, so they are kept.
+        self.initial = [-1 if var in vars else value for var, value in enumerate(self.initial)]
+        if not self._started or self._initial_mark is None:
+            return  # resume assigns the initial values, or arc consistency already failed
+        while self._stack:
+            self._undo(self._stack.pop())
+        self._restore(self._initial_mark)
+        for var in vars:
+            value = self.index.values[var]
+            if value >= 0:
+                if self.nogoods is not None:
+                    self.nogoods.unassign(var, value)
+                self.index.unassign(var)
+        self._status, self._descend, self._jump_to = PAUSED, True, None
+        if self.forward_checking and not self._forward_check_initial():
+            self._status = FAILED
+        self._rebuild_queue()
+
+    def pause(self):
+        # safe to call from another thread; the search stops before its next assignment
+        self._pause_requested = True
+
+    def checkpoint(self, path):
+        # written to a temporary file first so that a crash never leaves a torn checkpoint behind
+        _replace_file(path, lambda file: pickle.dump(self, file, protocol=pickle.HIGHEST_PROTOCOL), binary=True)
+
+    @staticmethod
+    def load_checkpoint(path):
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pause_requested'] = False
+        state['progress'] = None  # callbacks seldom pickle, attach a new one after loading
+        state['_next_progress'] = math.inf
+        return state
+
+    def _backtrack(self, max_nodes=None):
+        # Iterative backtracking over an explicit stack of choice points, one per assigned variable:
+        # [var, candidate values, position of the next candidate, trail mark of the current value,
+        # values skipped as mirror images of failed ones or None, masks of blocked values or None].
+        # All search state lives on the engine, so the loop can stop between nodes and carry on later.
+        index, stack, stats = self.index, self._stack, self.stats
+        node_limit = None if max_nodes is None else stats['nodes'] + max_nodes
+        while True:
+            if self._descend:
+                if index.assigned == len(self.variables):
+                    return SOLVED
+                if self._pause_requested or (node_limit is not None and stats['nodes'] >= node_limit):
+                    return PAUSED
+                if self._deadline is not None and stats['nodes'] >= self._next_clock_check:
+                    self._next_clock_check = stats['nodes'] + 256  # reading the clock every node costs too much
+                    if time.perf_counter() >= self._deadline:
+                        return PAUSED
+                if self._restart_limit is not None and stats['nodes'] >= self._restart_limit:
+                    self._restart()
+                if self.profile:
+                    start = time.perf_counter()
+                    var = self.select_unassigned_variable()
+                    stats['select_time'] += time.perf_counter() - start
+                else:
+                    var = self.select_unassigned_variable()
+                if var is None:
+                    return FAILED
+                self._conf_set[var].clear()
+                stack.append([var, self.order_domain_values(var), 0, 0, None, self._blocked(var)])
+
+            frame = stack[-1]
+            var, candidates = frame[0], frame[1]
+            conf_set = self._conf_set[var]
+            self._descend = False
+            while frame[2] < len(candidates):
+                if frame[2] and self._symmetric_values:
+                    self._skip_symmetric(frame, candidates[frame[2] - 1])
+                value = candidates[frame[2]]
+                frame[2] += 1
+                if frame[4] is not None and value in frame[4]:
+                    stats['symmetric_skips'] += 1
+                    continue
+                blocked = frame[5]
+                if blocked is None:
+                    culprits = self.find_culprits(var, value)
+                elif blocked[0] >> value & 1:
+                    culprits = self._culprits(var, value, [check for check, board in self._check_boards
+                                                           if blocked[board] >> value & 1])
+                else:
+                    culprits = self._culprits(var, value, self._other_checks)
+                if culprits is not None:
+                    conf_set.update(culprits)
+                    continue
+                self._depth[var] = index.assigned
+                index.assign(var, value)
+                if self.nogoods is not None:
+                    self.nogoods.assign(var, value)
+                stats['nodes'] += 1
+                if index.assigned > stats['max_depth']:
+                    stats['max_depth'] = index.assigned
+                    if self._best is not None:
+                        self._best = list(index.values)
+                if stats['nodes'] >= self._next_progress:
+                    self._next_progress += self.progress_every
+                    self._update_time()
+                    self.progress(self)
+                frame[3] = len(self._trail)
+                if not self.forward_checking:
+                    culprits = None
+                elif self.profile:
+                    start = time.perf_counter()
+                    culprits = self._forward_check(var, value)
+                    stats['forward_check_time'] += time.perf_counter() - start
+                else:
+                    culprits = self._forward_check(var, value)
+                if culprits is None:
+                    self._descend = True
+                    break
+                self._undo(frame)
+                stats['backtracks'] += 1
+                conf_set.update(culprits)
+                conf_set.discard(var)
+            if self._descend:
+                continue
+
+            # every candidate of var failed: back up to the choice point that can do something about it
+            stack.pop()
+            self._requeue(var)
+            if self.backjumping:
+                self._dead_end(var, conf_set)
+            while stack:
+                frame = stack[-1]
+                self._undo(frame)
+                stats['backtracks'] += 1
+                if self._jump_to is None:
+                    break
+                if self._jump_to == frame[0]:
+                    self._jump_to = None
+                    break
+                # this variable played no part in the dead end below, skip over it
+                stats['backjumps'] += 1
+                stack.pop()
+                self._requeue(frame[0])
+            if not stack:
+                return FAILED
+
+    def _blocked(self, var):
+        # one pass of bitwise operations over the bitboards, instead of calling every constraint per value
+        if not self._blocked_filter:
             return None
-        # MRV heuristic
-        return min(unassigned_vars, key=lambda var: len(self.domains[var]))
+        # (all blocked values, those blocked by constraint1, ... constraint4, -1 for any other constraint)
+        masks = self.index.blocked_values(var)
+        return (masks[0] | masks[1] | masks[2] | masks[3],) + masks + (-1,)
 
-    def order_domain_values(self, var, assignment):
-        return self.domains[var]
+    def _skip_symmetric(self, frame, value):
+        # value failed. While neither teacher has a class yet, handing it to an interchangeable teacher
+        # instead only renames the teachers in the failed branch, so that branch fails too
+        hours, value_teacher = self.index.teacher_hours, self.model.value_teacher
+        partners = self._symmetric_values.get(value)
+        if not partners or hours[value_teacher[value]]:
+            return
+        if frame[4] is None:
+            frame[4] = set()
+        frame[4].update(partner for partner in partners if not hours[value_teacher[partner]])
 
-    def backtracking_search(self):
-        assignment = {}
-        result = self._backtrack(assignment)
-        if not result:
+    def _undo(self, frame):
+        var = frame[0]
+        self._restore(frame[3])
+        if self.nogoods is not None:
+            self.nogoods.unassign(var, self.index.values[var])
+        self.index.unassign(var)
+
+    def _restart(self):
+        # start over from the root with fresh tie-breaking; learned nogoods hold everywhere and are kept
+        while self._stack:
+            self._undo(self._stack.pop())
+        if self.random is not None:
+            self._shuffle_ranks()
+        self._rebuild_queue()
+        self.stats['restarts'] += 1
+        if self.restarts == 'luby':
+            limit = self.restart_base * luby(self.stats['restarts'] + 1)
+        else:
+            limit = int(self.restart_base * 1.5 ** self.stats['restarts'])
+        self._restart_limit = self.stats['nodes'] + limit
+
+    def _dead_end(self, var, conf_set):
+        # every value of var failed because of conf_set: remember it and jump back to its latest member
+        if self.forward_checking:
+            conf_set.update(culprit for culprit in self.pruned[var] if culprit >= 0)
+        values = self.index.values
+        pairs = [(other, values[other]) for other in conf_set]
+        if self.nogoods.add(pairs):
+            self.stats['nogoods_learned'] += 1
+        for var_map, value_map in self._generators:
+            image = [(var_map.get(other, other), value_map.get(value, value)) for other, value in pairs]
+            if self.nogoods.add(image, values):
+                self.stats['nogoods_learned'] += 1
+        if not conf_set:
+            self._jump_to = -1
+            return
+        target = max(conf_set, key=self._depth.__getitem__)
+        self._jump_to = target
+        self._conf_set[target].update(conf_set)
+        self._conf_set[target].discard(target)
+
+
+class LocalSearchEngine:
+    # Min-conflicts local search over complete timetables, moving one class at a time and steered by a
+    # tabu list or by simulated annealing. The objective weighs hard violations of the built-in
+    # constraints against the soft ones (Teacher.preferred_class, balanced workloads), and every move
+    # is scored incrementally from per-bucket counters. It finds good timetables for large schools
+    # quickly but cannot prove that none exists.
+    def __init__(self, model, constraints, method='tabu', seed=0, max_steps=200000, time_limit=None, patience=5000,
+                 hard_weight=1000, preference_weight=1, balance_weight=1, tabu_tenure=10, temperature=2.0,
+                 cooling=0.9995, initial=None, progress=None, progress_every=1000):
+        self.model = model
+        self.variables = range(len(model.variable_names))
+        self.domains = model.domains
+        self.constraints = constraints
+        self.method = method  # 'tabu' or 'annealing'
+        self.random = random.Random(seed)
+        self.max_steps = max_steps
+        self.time_limit = time_limit  # seconds
+        self.patience = patience  # steps without improvement before giving up once the timetable is valid
+        self.hard_weight = hard_weight
+        self.preference_weight = preference_weight
+        self.balance_weight = balance_weight
+        self.tabu_tenure = tabu_tenure
+        self.temperature = temperature
+        self.cooling = cooling
+        self.initial = initial  # values to start from, -1 for classes the greedy start should fill
+        # progress(engine) is called every progress_every steps, and may call engine.pause()
+        self.progress = progress
+        self.progress_every = progress_every
+        self._pause_requested = False
+        self.conflict_log = ConflictLog(model)
+        self.stats = {'steps': 0, 'hard_violations': 0, 'soft_penalty': 0}
+
+        self.values = [-1] * len(self.variables)
+        self.subject_count = [0] * (model.num_class_days * len(model.subject_names))
+        self.slot_count = [0] * (len(model.day_names) * len(model.slot_keys) * len(model.teacher_names))
+        self.load = [0] * len(model.teacher_names)  # classes per teacher
+        self.capacity = [hours // 2 for hours in model.teacher_max_hours]
+        self.hard = 0
+        self.soft = 0
+
+    def solve(self):
+        # (None, None) if pause() stopped it before any timetable was valid
+        best = self._search()
+        self.stats['hard_violations'] = best[0]
+        self.stats['soft_penalty'] = best[1]
+        if best[0]:
+            if self._pause_requested:
+                return None, None
+            self._record_violations(best[2])
             return None, self.conflict_log
-        return result, None
+        return best[2], None
+
+    def pause(self):
+        # safe to call from another thread; the search stops before its next step with the best so far
+        self._pause_requested = True
 
-    def _backtrack(self, assignment):
-        if len(assignment) == len(self.variables):
-            return assignment
+    backtracking_search = solve
 
-        var = self.select_unassigned_variable(assignment)
-        if var is None:
+    def _search(self):
+        values, random_source = self.values, self.random
+        self._greedy_start()
+        best = (self.hard, self.soft, list(values))
+        best_objective = self._objective()
+        since_improvement = 0
+        temperature = self.temperature
+        tabu = {}  # (var, value) -> step until which moving var back to value is forbidden
+        deadline = None if self.time_limit is None else time.monotonic() + self.time_limit
+        for step in range(1, self.max_steps + 1):
+            self.stats['steps'] = step
+            if deadline is not None and step % 256 == 0 and time.monotonic() > deadline:
+                break
+            if self.progress is not None and step % self.progress_every == 0:
+                self.progress(self)
+            if self._pause_requested:
+                break
+            if best[0] == 0 and (best[1] == 0 or since_improvement >= self.patience):
+                break
+            since_improvement += 1
+            var = self._pick_variable()
+            if len(self.domains[var]) < 2:
+                continue
+            if self.method == 'annealing':
+                value = random_source.choice(self.domains[var])
+                if value == values[var]:
+                    continue
+                hard, soft = self._delta(var, value)
+                delta = hard * self.hard_weight + soft
+                if delta > 0 and random_source.random() >= math.exp(-delta / max(temperature, 1e-9)):
+                    continue
+                temperature *= self.cooling
+            else:
+                value, hard, soft = self._best_move(var, tabu, step, best_objective)
+                if value < 0:
+                    continue
+                tabu[(var, values[var])] = step + self.tabu_tenure
+            self._move(var, value, hard, soft)
+            objective = self._objective()
+            if objective < best_objective:
+                best_objective = objective
+                best = (self.hard, self.soft, list(values))
+                since_improvement = 0
+        return best
+
+    def _objective(self):
+        return self.hard * self.hard_weight + self.soft
+
+    def _greedy_start(self):
+        # keep the given values, then place every other class where it adds the least to the objective
+        initial = self.initial or ()
+        for var, value in enumerate(initial):
+            if value >= 0:
+                hard, soft = self._delta(var, value)
+                self._move(var, value, hard, soft)
+        for var in sorted(self.variables, key=lambda v: len(self.domains[v])):
+            if self.values[var] >= 0:
+                continue
+            best_value, best_hard, best_soft = -1, 0, 0
+            for value in self.domains[var]:
+                hard, soft = self._delta(var, value)
+                if best_value < 0 or hard * self.hard_weight + soft < best_hard * self.hard_weight + best_soft:
+                    best_value, best_hard, best_soft = value, hard, soft
+            self._move(var, best_value, best_hard, best_soft)
+
+    def _pick_variable(self):
+        # min-conflicts: a class involved in a hard violation if there is one, otherwise any class
+        random_source, num_vars = self.random, len(self.variables)
+        if self.hard:
+            for _ in range(64):
+                var = random_source.randrange(num_vars)
+                if self._var_violations(var):
+                    return var
+            conflicted = [var for var in self.variables if self._var_violations(var)]
+            if conflicted:
+                return random_source.choice(conflicted)
+        return random_source.randrange(num_vars)
+
+    def _best_move(self, var, tabu, step, best_objective):
+        current = self._objective()
+        best_value, best_hard, best_soft, best_delta, ties = -1, 0, 0, None, 0
+        for value in self.domains[var]:
+            if value == self.values[var]:
+                continue
+            hard, soft = self._delta(var, value)
+            delta = hard * self.hard_weight + soft
+            # tabu moves are allowed only if they beat the best timetable seen so far (aspiration)
+            if tabu.get((var, value), 0) > step and current + delta >= best_objective:
+                continue
+            if best_delta is None or delta < best_delta:
+                best_value, best_hard, best_soft, best_delta, ties = value, hard, soft, delta, 1
+            elif delta == best_delta:
+                ties += 1
+                if self.random.randrange(ties) == 0:
+                    best_value, best_hard, best_soft = value, hard, soft
+        return best_value, best_hard, best_soft
+
+    def _preference_penalty(self, teacher, var):
+        preferred = self.model.teacher_preferred[teacher]
+        if preferred is None:
+            return 0
+        grade, section = preferred
+        model = self.model
+        return 0 if model.var_grade[var] == grade and section in (-1, model.var_section[var]) else 1
+
+    def _delta(self, var, value):
+        # (hard, soft) change of the objective if var took value
+        model, values, constraints = self.model, self.values, self.constraints
+        old = values[var]
+        if old == value:
+            return 0, 0
+        old_subject = model.value_subject[old] if old >= 0 else -1
+        old_teacher = model.value_teacher[old] if old >= 0 else -1
+        subject, teacher = model.value_subject[value], model.value_teacher[value]
+        hard = soft = 0
+        if subject != old_subject and constraint1 in constraints:
+            base = model.placed_key(model.var_class_day[var], 0)
+            if old_subject >= 0 and self.subject_count[base + old_subject] >= 2:
+                hard -= 1
+            if self.subject_count[base + subject] >= 1:
+                hard += 1
+        if teacher != old_teacher:
+            if constraint2 in constraints:
+                base = model.busy_key(model.var_day[var], model.var_slot[var], 0)
+                if old_teacher >= 0 and self.slot_count[base + old_teacher] >= 2:
+                    hard -= 1
+                if self.slot_count[base + teacher] >= 1:
+                    hard += 1
+            if constraint3 in constraints:
+                for other in model.adjacent_vars[var]:
+                    other_value = values[other]
+                    if other_value >= 0:
+                        other_teacher = model.value_teacher[other_value]
+                        if other_teacher == old_teacher:
+                            hard -= 1
+                        elif other_teacher == teacher:
+                            hard += 1
+            if constraint4 in constraints:
+                if old_teacher >= 0 and self.load[old_teacher] > self.capacity[old_teacher]:
+                    hard -= 1
+                if self.load[teacher] >= self.capacity[teacher]:
+                    hard += 1
+            # sum of squared loads shrinks as the classes spread out more evenly
+            balance = 2 * self.load[teacher] + 1
+            preference = self._preference_penalty(teacher, var)
+            if old_teacher >= 0:
+                balance -= 2 * self.load[old_teacher] - 1
+                preference -= self._preference_penalty(old_teacher, var)
+            soft += self.balance_weight * balance + self.preference_weight * preference
+        return hard, soft
+
+    def _move(self, var, value, hard, soft):
+        model = self.model
+        old = self.values[var]
+        if old >= 0:
+            self.subject_count[model.placed_key(model.var_class_day[var], model.value_subject[old])] -= 1
+            self.slot_count[model.busy_key(model.var_day[var], model.var_slot[var], model.value_teacher[old])] -= 1
+            self.load[model.value_teacher[old]] -= 1
+        self.values[var] = value
+        self.subject_count[model.placed_key(model.var_class_day[var], model.value_subject[value])] += 1
+        self.slot_count[model.busy_key(model.var_day[var], model.var_slot[var], model.value_teacher[value])] += 1
+        self.load[model.value_teacher[value]] += 1
+        self.hard += hard
+        self.soft += soft
+
+    def _var_violations(self, var, values=None):
+        # hard violations var takes part in, as (constraint name, count) pairs
+        model, constraints = self.model, self.constraints
+        values = self.values if values is None else values
+        value = values[var]
+        subject, teacher = model.value_subject[value], model.value_teacher[value]
+        violations = []
+        if constraint1 in constraints:
+            count = self.subject_count[model.placed_key(model.var_class_day[var], subject)] - 1
+            if count > 0:
+                violations.append(('constraint1', count))
+        if constraint2 in constraints:
+            count = self.slot_count[model.busy_key(model.var_day[var], model.var_slot[var], teacher)] - 1
+            if count > 0:
+                violations.append(('constraint2', count))
+        if constraint3 in constraints:
+            count = sum(1 for other in model.adjacent_vars[var]
+                        if values[other] >= 0 and model.value_teacher[values[other]] == teacher)
+            if count > 0:
+                violations.append(('constraint3', count))
+        if constraint4 in constraints and self.load[teacher] > self.capacity[teacher]:
+            violations.append(('constraint4', 1))
+        return violations
+
+    def _record_violations(self, values):
+        # rebuild the counters for the best timetable and log what is still broken in it
+        for var in self.variables:
+            if self.values[var] != values[var]:
+                hard, soft = self._delta(var, values[var])
+                self._move(var, values[var], hard, soft)
+        for var in self.variables:
+            for reason, count in self._var_violations(var):
+                for _ in range(count):
+                    self.conflict_log.record(reason, var, values[var])
+
+
+def timetable_penalties(model, constraints, solution):
+    # (hard violations, soft penalty) of a complete timetable, scored the way LocalSearchEngine does
+    engine = LocalSearchEngine(model, constraints, initial=solution)
+    engine._greedy_start()
+    return engine.hard, engine.soft
+
+
+def portfolio_configs(workers):
+    # worker 0 is the plain engine, the rest vary the seed, value ordering and restart policy
+    orders = ['least_loaded', 'lcv', 'random']
+    configs = [{'forward_checking': True, 'backjumping': True}]
+    for i in range(1, workers):
+        configs.append({'forward_checking': True, 'backjumping': i % 2 == 1, 'seed': i,
+                        'value_order': orders[(i - 1) % len(orders)], 'restarts': 'luby' if i % 2 else 'geometric'})
+    return configs
+
+
+_search_stops = ()  # set in each worker process by _init_search_worker
+
+
+def _init_search_worker(*stops):
+    global _search_stops
+    _search_stops = stops
+
+
+class _StopCheck:
+    # CSPEngine and LocalSearchEngine progress callback that pauses the search once the stop event is set
+    # or the time.monotonic() deadline has passed; a class rather than a closure so that it pickles into
+    # worker processes too
+    def __init__(self, stop=None, deadline=None):
+        self.stop = stop
+        self.deadline = deadline
+
+    def __call__(self, engine):
+        if (self.stop is not None and self.stop.is_set()) or \
+                (self.deadline is not None and time.monotonic() >= self.deadline):
+            engine.pause()
+
+
+def _search_worker(model, constraints, config, chunk):
+    # searches in chunks of nodes so that it notices when the other workers make it pointless to go on
+    start = time.perf_counter()
+    engine = CSPEngine(model, constraints, **config)
+    status = PAUSED
+    while status == PAUSED and not any(stop.is_set() for stop in _search_stops):
+        status = engine.resume(max_nodes=chunk)
+    values = list(engine.index.values) if status == SOLVED else None
+    counts = engine.conflict_log.counts if status == FAILED else None
+    return status, values, counts, dict(engine.stats, time=time.perf_counter() - start)
+
+
+def portfolio_search(model, constraints, workers=None, configs=None, time_limit=None, chunk=1000, stop=None):
+    # Runs one CSPEngine per config in its own process. The first worker to finish wins: a solution,
+    # or a proof that none exists. The others are told to stop and report how far they got. Setting
+    # stop, a multiprocessing Event of the caller's, stops them all.
+    # Returns (solution, conflicts, reports), with (None, None, reports) if time_limit ran out or stop was set.
+    if configs is None:
+        configs = portfolio_configs(workers or os.cpu_count() or 1)
+    finished = Event()
+    stops = (finished,) if stop is None else (finished, stop)
+    solution, conflicts, winner = None, None, None
+    reports = [{'worker': i, 'config': config, 'status': PAUSED} for i, config in enumerate(configs)]
+    with ProcessPoolExecutor(max_workers=len(configs), initializer=_init_search_worker, initargs=stops) as pool:
+        futures = {pool.submit(_search_worker, model, constraints, config, chunk): i
+                   for i, config in enumerate(configs)}
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        pending = set(futures)
+        while pending:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                finished.set()
+                deadline = None
+                continue
+            for future in done:
+                status, values, counts, stats = future.result()
+                i = futures[future]
+                reports[i].update(stats, status=status)
+                if winner is None and status != PAUSED:
+                    winner = i
+                    reports[i]['winner'] = True
+                    finished.set()
+                    if status == SOLVED:
+                        solution = values
+                    else:
+                        conflicts = ConflictLog(model)
+                        conflicts.counts.update(counts)
+    return solution, conflicts, reports
+
+
+def constraint_components(model, constraints):
+    # Groups of variables that no active constraint links to each other, so each group can be solved on
+    # its own. constraint4 ties together every class a teacher could take, constraint1 the classes of one
+    # grade, day and section; without constraint4 a teacher only links classes in the same or adjacent
+    # slots. Unknown constraints might link anything, so they keep the problem in one piece.
+    parent = list(range(len(model.variable_names)))
+
+    def find(var):
+        while parent[var] != var:
+            parent[var] = parent[parent[var]]
+            var = parent[var]
+        return var
+
+    def union(group):
+        if group:
+            root = find(group[0])
+            for var in group:
+                other = find(var)
+                if other != root:
+                    parent[other] = root
+
+    if any(constraint not in (constraint1, constraint2, constraint3, constraint4) for constraint in constraints):
+        return [list(range(len(parent)))]
+    if constraint1 in constraints:
+        for group in model.class_day_vars:
+            union(group)
+    if constraint4 in constraints:
+        for group in model.teacher_vars:
+            union(group)
+    else:
+        domain_teachers = [{model.value_teacher[value] for value in domain} for domain in model.domains]
+        if constraint2 in constraints:
+            for group in model.day_slot_vars:
+                for teacher in {teacher for var in group for teacher in domain_teachers[var]}:
+                    union([var for var in group if teacher in domain_teachers[var]])
+        if constraint3 in constraints:
+            for var, others in enumerate(model.adjacent_vars):
+                for other in others:
+                    if domain_teachers[var] & domain_teachers[other]:
+                        union([var, other])
+    components = {}
+    for var in range(len(parent)):
+        components.setdefault(find(var), []).append(var)
+    return list(components.values())
+
+
+def decomposed_search(model, constraints, workers=1, chunk=1000, time_limit=None, stop=None, **options):
+    # Solves each constraint component with its own CSPEngine(**options), in a process pool when
+    # workers > 1, and merges the parts into one solution. If any part has no solution neither has the
+    # whole, and the remaining parts are stopped. Setting stop, a multiprocessing Event of the caller's,
+    # stops every part. Returns (solution, conflicts, reports), with (None, None, reports) if time_limit
+    # ran out or stop was set.
+    components = constraint_components(model, constraints)
+    submodels = [model.submodel(vars) if len(components) > 1 else model for vars in components]
+    reports = [{'component': i, 'variables': len(vars), 'status': PAUSED} for i, vars in enumerate(components)]
+    results = [None] * len(components)
+    if workers > 1 and len(components) > 1:
+        finished = Event()
+        with ProcessPoolExecutor(max_workers=min(workers, len(components)), initializer=_init_search_worker,
+                                 initargs=(finished,) if stop is None else (finished, stop)) as pool:
+            futures = {pool.submit(_search_worker, submodel, constraints, options, chunk): i
+                       for i, submodel in enumerate(submodels)}
+            try:
+                for future in as_completed(futures, timeout=time_limit):
+                    i = futures[future]
+                    results[i] = future.result()
+                    if results[i][0] == FAILED:
+                        finished.set()
+            except TimeoutError:
+                finished.set()
+                for future, i in futures.items():
+                    results[i] = future.result()
+    else:
+        deadline = None if time_limit is None else time.monotonic() + time_limit
+        for i, submodel in enumerate(submodels):
+            engine = CSPEngine(submodel, constraints, **options)
+            start = time.perf_counter()
+            chunked = deadline is not None or stop is not None
+            status = engine.resume(chunk if chunked else None)
+            while status == PAUSED and chunked and (deadline is None or time.monotonic() < deadline) and \
+                    (stop is None or not stop.is_set()):
+                status = engine.resume(chunk)
+            values = list(engine.index.values) if status == SOLVED else None
+            counts = engine.conflict_log.counts if status == FAILED else None
+            results[i] = status, values, counts, dict(engine.stats, time=time.perf_counter() - start)
+            if status != SOLVED:
+                break
+
+    solution, conflicts = [-1] * len(model.variable_names), None
+    value_ids = {names: value for value, names in enumerate(model.value_names)}
+    for i, result in enumerate(results):
+        if result is None:
+            continue
+        status, values, counts, stats = result
+        reports[i].update(stats, status=status)
+        submodel = submodels[i]
+        if status == SOLVED:
+            for var, value in zip(components[i], values):
+                solution[var] = value_ids[submodel.value_names[value]]
+        elif status == FAILED:
+            if conflicts is None:
+                conflicts = ConflictLog(model)
+            part = ConflictLog(submodel)
+            part.counts.update(counts)
+            conflicts.merge(part)
+    if conflicts is not None or any(value < 0 for value in solution):
+        return None, conflicts, reports
+    return solution, None, reports
+
+
+def apply_changes(model, changes):
+    # The model after a list of changes, each one of
+    #   ('remove_teacher', teacher)
+    #   ('add_qualification', teacher, grade, subject)
+    #   ('set_max_hours', teacher, hours)
+    #   ('block_slot', teacher, day, time slot)   the teacher cannot teach then
+    # The changes are patched into a copy of the compiled model, visiting only the classes they concern
+    # instead of compiling the school again. Variable, teacher and value ids carry over: a teacher who
+    # left keeps an id with no values, and a new qualification takes the next value id.
+    teachers = {t.name: t for t in model.teacher_pool}
+    teacher_ids = {name: i for i, name in enumerate(model.teacher_names)}
+    value_ids = {names: value for value, names in enumerate(model.value_names)}
+    value_names, value_subject, value_teacher = list(model.value_names), array('i', model.value_subject), \
+        array('i', model.value_teacher)
+    subject_values, teacher_values = list(model.subject_values), list(model.teacher_values)
+    domains, domain_masks = list(model.domains), list(model.domain_masks)
+    teacher_vars, teacher_max_hours = list(model.teacher_vars), array('i', model.teacher_max_hours)
+
+    def drop_teacher(var, teacher):
+        domains[var] = tuple(value for value in domains[var] if value_teacher[value] != teacher)
+        domain_masks[var] &= ~teacher_values[teacher]
+
+    for change in changes:
+        kind, name = change[0], change[1]
+        teacher = teacher_ids.get(name)
+        if kind == 'remove_teacher':
+            teachers.pop(name, None)
+            if teacher is not None:
+                for var in teacher_vars[teacher]:
+                    drop_teacher(var, teacher)
+                teacher_vars[teacher] = ()
+        elif kind == 'add_qualification':
+            grade_number, subject_name = change[2], change[3]
+            old = teachers[name]
+            teachers[name] = Teacher(name, list(old.grade_subject_pairs) + [(grade_number, subject_name)],
+                                     old.preferred_class, old.max_hours)
+            if grade_number not in model.grade_numbers or subject_name not in model.subject_names:
+                continue  # no class of the grade has the subject
+            grade, subject = model.grade_numbers.index(grade_number), model.subject_names.index(subject_name)
+            value = value_ids.get((subject_name, name))
+            gained = [var for var, var_grade in enumerate(model.var_grade)
+                      if var_grade == grade and domain_masks[var] & subject_values[subject] and
+                      (value is None or not domain_masks[var] >> value & 1)]
+            if not gained:
+                continue
+            if value is None:
+                value = value_ids[subject_name, name] = len(value_names)
+                value_names.append((subject_name, name))
+                value_subject.append(subject)
+                value_teacher.append(teacher)
+                subject_values[subject] |= 1 << value
+                teacher_values[teacher] |= 1 << value
+            for var in gained:
+                domains[var] += (value,)
+                domain_masks[var] |= 1 << value
+            teacher_vars[teacher] = tuple(sorted(set(teacher_vars[teacher]).union(gained)))
+        elif kind == 'set_max_hours':
+            old = teachers[name]
+            teachers[name] = Teacher(name, list(old.grade_subject_pairs), old.preferred_class, change[2])
+            teacher_max_hours[teacher] = change[2]
+        elif kind == 'block_slot':
+            day, time_slot = change[2], change[3]
+            if teacher is None or day not in model.day_names or time_slot not in model.slot_keys:
+                continue
+            day_slot = model.day_names.index(day) * len(model.slot_keys) + model.slot_keys.index(time_slot)
+            blocked = {var for var in model.day_slot_vars[day_slot] if domain_masks[var] & teacher_values[teacher]}
+            for var in blocked:
+                drop_teacher(var, teacher)
+            teacher_vars[teacher] = tuple(var for var in teacher_vars[teacher] if var not in blocked)
+        else:
+            raise ValueError(f"Unknown change '{kind}'")
+
+    patched = copy.copy(model)
+    patched.teacher_pool = tuple(teachers.values())
+    patched.teacher_max_hours = teacher_max_hours
+    patched.value_names, patched.value_subject, patched.value_teacher = tuple(value_names), value_subject, \
+        value_teacher
+    patched.subject_values, patched.teacher_values = tuple(subject_values), tuple(teacher_values)
+    patched.domains, patched.domain_masks = tuple(domains), tuple(domain_masks)
+    patched.teacher_vars = tuple(teacher_vars)
+    return patched
+
+
+def _repair_neighbours(model, index, previous, free):
+    # classes that share a constraint with a freed one, and the other classes its old teacher kept
+    neighbours = set()
+    for var in free:
+        neighbours.update(model.class_day_vars[model.var_class_day[var]])
+        neighbours.update(model.day_slot_vars[model.var_day[var] * len(model.slot_keys) + model.var_slot[var]])
+        neighbours.update(model.adjacent_vars[var])
+        if previous[var] >= 0:
+            neighbours.update(index.teacher_assignments(model.value_teacher[previous[var]]))
+    return neighbours - free
+
+
+def repair(model, solution, changes, constraints, max_radius=3, max_nodes=10000, **options):
+    # Updates a timetable after apply_changes(model, changes) while moving as few classes as possible.
+    # Returns (new model, solution, conflicts, names of the classes that changed).
+    new_model = apply_changes(model, changes)
+    solution, conflicts, changed = warm_start(new_model, solution, constraints, max_radius, max_nodes, **options)
+    return new_model, solution, conflicts, changed
+
+
+def warm_start(model, previous, constraints, max_radius=3, max_nodes=10000, **options):
+    # Solves model starting from an earlier timetable, previous[var] being its value or -1. Classes whose
+    # old value no longer fits are freed and re-solved with everything else fixed; if that fails the ring
+    # of classes around them is freed as well, up to max_radius rings of max_nodes each, before falling
+    # back to a full solve. Old values are always tried first.
+    # Returns (solution, conflicts, names of the classes that changed), with (None, None, []) if a progress
+    # callback paused the search.
+    index = ScheduleIndex(model)
+    free = set()
+    for var, value in enumerate(previous):
+        if value in model.domains[var] and all(constraint(var, value, index)[0] for constraint in constraints):
+            index.assign(var, value)
+        else:
+            free.add(var)
+
+    # one engine serves every ring: widening releases the ring's fixed values instead of starting again
+    initial = [-1 if var in free else value for var, value in enumerate(previous)]
+    engine = CSPEngine(model, constraints, initial=initial, hints=previous, **options)
+    radius = 0
+    while True:
+        whole = radius > max_radius
+        if whole:
+            engine = CSPEngine(model, constraints, hints=previous, **options)
+        status = engine.resume(None if whole else max_nodes)
+        if status == SOLVED:
+            values = list(engine.index.values)
+            changed = [model.variable_names[var] for var, value in enumerate(values) if value != previous[var]]
+            return values, None, changed
+        if status == PAUSED and engine._pause_requested:
+            return None, None, []
+        if whole:
+            return None, engine.conflict_log, []
+        neighbours = _repair_neighbours(model, index, previous, free)
+        for var in neighbours:
+            if index.values[var] >= 0:
+                index.unassign(var)
+        engine.release(neighbours)
+        free |= neighbours
+        radius += 1
+
+
+def school_problem(grades, teacher_pool, time_slots, day_schedule_map, constraints):
+    # The school as plain lists in the order it was written down, ready for JSON: the form the job service
+    # takes, since the days keep their weekday order and the exported timetables follow it
+    def preferred(preferred_class):
+        return list(preferred_class) if isinstance(preferred_class, tuple) else preferred_class
+    return {
+        'constraints': [constraint.__name__ for constraint in constraints],
+        'grades': [[grade.grade_number, list(grade.sections),
+                    [[day_type, list(subjects)] for day_type, subjects in grade.subjects_day.items()]]
+                   for grade in grades],
+        'days': [[day, day_type] for day, day_type in day_schedule_map.items()],
+        'time_slots': [[time_slot, label] for time_slot, label in time_slots.items()],
+        'teachers': [[t.name, [list(pair) for pair in t.grade_subject_pairs], preferred(t.preferred_class), t.max_hours]
+                     for t in teacher_pool],
+    }
+
+
+def canonical_problem(grades, teacher_pool, time_slots, day_schedule_map, constraints):
+    # school_problem with every list sorted, so that the order it was written down in does not matter
+    # and it can be compared, hashed and stored as JSON. The days come out in alphabetical order.
+    problem = school_problem(grades, teacher_pool, time_slots, day_schedule_map, constraints)
+    return {
+        'constraints': problem['constraints'],
+        'grades': sorted([grade_number, sorted(sections), sorted([day_type, sorted(subjects)]
+                                                                 for day_type, subjects in subjects_day)]
+                         for grade_number, sections, subjects_day in problem['grades']),
+        'days': sorted(problem['days']),
+        'time_slots': sorted(problem['time_slots']),
+        'teachers': sorted([name, [list(pair) for pair in sorted({tuple(pair) for pair in pairs})], preferred,
+                            max_hours] for name, pairs, preferred, max_hours in problem['teachers']),
+    }
+
+
+def school_from_problem(problem):
+    # (grades, teacher_pool, time_slots, day_schedule_map, constraints) back from the school_problem form,
+    # e.g. a school sent as JSON. Lists are read in the order given, so days keep theirs; a canonical_problem
+    # reads back too, but with its days in alphabetical order.
+    named = {constraint.__name__: constraint for constraint in builtin_constraints}
+    unknown = [name for name in problem['constraints'] if name not in named]
+    if unknown:
+        raise ValueError(f"Unknown constraints: {', '.join(unknown)}")
+    grades = [Grade(grade_number, list(sections), {day_type: list(subjects) for day_type, subjects in subjects_day})
+              for grade_number, sections, subjects_day in problem['grades']]
+    teacher_pool = [Teacher(name, [tuple(pair) for pair in pairs],
+                            tuple(preferred) if isinstance(preferred, list) else preferred, max_hours)
+                    for name, pairs, preferred, max_hours in problem['teachers']]
+    time_slots = {time_slot: label for time_slot, label in problem['time_slots']}
+    day_schedule_map = {day: day_type for day, day_type in problem['days']}
+    return grades, teacher_pool, time_slots, day_schedule_map, [named[name] for name in problem['constraints']]
+
+
+def problem_key(problem):
+    # (key of the whole problem, key of the school without its teachers)
+    school = {name: part for name, part in problem.items() if name != 'teachers'}
+    return tuple(hashlib.sha256(json.dumps(part, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+                 for part in (problem, school))
+
+
+def _replace_file(path, write, binary=False, newline=None):
+    # Calls write(file) on a temporary file of its own next to path, then moves it into place, so a
+    # crash never leaves a torn file behind and concurrent writers of one path never share one.
+    # newline is passed on to open, '' for the csv module.
+    descriptor, temp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix='.tmp',
+                                             dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(descriptor, 'wb' if binary else 'w', newline=newline) as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+class SolutionCache:
+    # Timetables and proven infeasibilities on disk, one JSON file per problem under a directory per
+    # school layout, so that schools differing only in their teachers are found together. Reading an
+    # entry marks it as recently used; once the files take more than max_bytes the least recently used
+    # ones are deleted.
+    def __init__(self, directory='cache', max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key, school_key):
+        return os.path.join(self.directory, school_key, f"{key}.json")
+
+    def get(self, key, school_key):
+        path = self._path(key, school_key)
+        entry = self._read(path)
+        if entry is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass  # evicted by another process since
+        return entry
+
+    def similar(self, school_key):
+        # (key, entry) for every problem with the same school layout, whatever its teachers
+        directory = os.path.join(self.directory, school_key)
+        names = os.listdir(directory) if os.path.isdir(directory) else []
+        for name in names:
+            if name.endswith('.json'):
+                entry = self._read(os.path.join(directory, name))
+                if entry is not None:
+                    yield name[:-len('.json')], entry
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None  # evicted meanwhile, or not a cache entry
+
+    def put(self, key, school_key, entry):
+        # written to a temporary file first, like checkpoints, so readers never see half an entry
+        path = self._path(key, school_key)
+        for attempt in range(3):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                _replace_file(path, lambda file: json.dump(entry, file, separators=(',', ':')))
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise  # another process's _evict kept removing the school's directory
+        self._evict(keep=path)
+
+    def _evict(self, keep):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue  # being written by another process
+                path = os.path.join(root, name)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                files.append((status.st_mtime, status.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass  # other entries of the school are still there
+
+
+def _teacher_changes(problem, other):
+    # how many teachers were added, removed or changed between two canonical problems
+    teachers = {t[0]: t for t in problem['teachers']}
+    other_teachers = {t[0]: t for t in other['teachers']}
+    return sum(teachers.get(name) != other_teachers.get(name) for name in set(teachers) | set(other_teachers))
+
+
+def cached_solve(cache, grades, teacher_pool, time_slots, day_schedule_map, constraints, max_teacher_changes=2,
+                 **options):
+    # Solves the school with CSPEngine(**options) unless the cache already holds the answer. A miss
+    # warm-starts from the cached timetable of the same school layout with the fewest changed teachers,
+    # if no more than max_teacher_changes differ, and the answer is stored either way.
+    # Returns (model, solution, conflicts, 'cache', 'warm start' or 'solve').
+    problem = canonical_problem(grades, teacher_pool, time_slots, day_schedule_map, constraints)
+    key, school_key = problem_key(problem)
+    model = build_model(grades, teacher_pool, time_slots, day_schedule_map)
+    value_ids = {names: value for value, names in enumerate(model.value_names)}
+    variable_ids = {names: var for var, names in enumerate(model.variable_keys)}
+
+    def previous_values(timetable):
+        previous = [-1] * len(model.variable_keys)
+        for grade_number, day, section, time_slot, subject, teacher in timetable:
+            var = variable_ids.get((grade_number, day, section, time_slot))
+            if var is not None:
+                previous[var] = value_ids.get((subject, teacher), -1)
+        return previous
+
+    entry = cache.get(key, school_key)
+    if entry is not None and entry['problem'] == problem:
+        if entry['status'] == 'infeasible':
+            conflicts = ConflictLog(model)
+            conflicts.add_entries(entry['conflicts'])
+            return model, None, conflicts, 'cache'
+        solution = previous_values(entry['timetable'])
+        if -1 not in solution:
+            return model, solution, None, 'cache'
+
+    nearest = min(((_teacher_changes(problem, other['problem']), other_key, other)
+                   for other_key, other in cache.similar(school_key)
+                   if other['status'] == 'solved' and other['problem'] != problem),
+                  key=lambda candidate: candidate[0], default=None)
+    if nearest is not None and nearest[0] <= max_teacher_changes:
+        cache.get(nearest[1], school_key)  # mark it as used
+        solution, conflicts, _ = warm_start(model, previous_values(nearest[2]['timetable']), constraints, **options)
+        source = 'warm start'
+    else:
+        solution, conflicts = CSPEngine(model, constraints, **options).solve()
+        source = 'solve'
+
+    if solution is not None:
+        timetable = [list(model.variable_keys[var] + model.value_names[value]) for var, value in enumerate(solution)]
+        cache.put(key, school_key, {'problem': problem, 'status': 'solved', 'timetable': timetable})
+    elif conflicts is not None:
+        cache.put(key, school_key, {'problem': problem, 'status': 'infeasible',
+                                    'conflicts': [list(entry) for entry in conflicts.entries()]})
+    return model, solution, conflicts, source
+
+
+class Substitutions:
+    # Picking substitutes, shared by the in-memory Schedule and the SQLite ScheduleStore. Subclasses
+    # provide slot_ids and teachers(), is_busy(), teaches_section(), teaches_subject() and reassign().
+    def priority(self, teacher, grade, section, slot, day, subject):
+        # 3 for a teacher who already teaches the section, otherwise 2 for one who teaches the subject,
+        # plus 1 when the teacher has no class directly before or after
+        if self.teaches_section(teacher, grade, section):
+            priority = 3
+        elif self.teaches_subject(teacher, subject):
+            priority = 2
+        else:
+            priority = 0
+        if not self.is_busy(teacher, day, slot - 1) and not self.is_busy(teacher, day, slot + 1):
+            priority += 1
+        return priority
+
+    def substitute(self, teacher, grade, section, timeslot, day, subject, unavailable=()):
+        # gives the class to the free teacher with the highest priority; None if nobody qualifies
+        slot = self.slot_ids[timeslot]
+        substitute, max_priority = None, 0
+        for candidate in self.teachers():
+            if candidate == teacher or candidate in unavailable or self.is_busy(candidate, day, slot):
+                continue
+            priority = self.priority(candidate, grade, section, slot, day, subject)
+            if priority > max_priority:
+                substitute, max_priority = candidate, priority
+        if substitute is None:
             return None
+        self.reassign((grade, day, section, slot), subject, substitute)
+        return substitute
 
-        for value in self.order_domain_values(var, assignment):
-            if self.is_consistent(var, value, assignment):
-                assignment[var] = value
-                result = self._backtrack(assignment)
-                if result:
-                    return result
-                del assignment[var]
-        return None
+    def substitute_all(self, absences):
+        # absences: (teacher, grade, section, timeslot, day, subject) tuples, handled in order so that
+        # no substitute is booked twice; a teacher absent on a day never covers for anyone that day
+        absent = {(teacher, day) for teacher, _, _, _, day, _ in absences}
+        substitutes = []
+        for teacher, grade, section, timeslot, day, subject in absences:
+            unavailable = {other for other, absent_day in absent if absent_day == day}
+            substitutes.append(self.substitute(teacher, grade, section, timeslot, day, subject, unavailable))
+        return substitutes
+
+
+class Schedule(Substitutions):
+    # The exported timetable held in memory, read once from the grade CSVs or taken straight from a
+    # solution, and indexed for substitution: (day, slot) -> busy teachers, teacher -> classes and
+    # (grade, section) -> teachers, so every check on a candidate is a lookup. Rows are edited in
+    # place and save() writes all changed grades back together.
+    header = ["Grade", "Day", "Section", "Time Slot", "Subject", "Teacher"]
+
+    def __init__(self, time_slots):
+        self.time_slots = time_slots
+        self.slot_ids = {time_range: slot for slot, time_range in time_slots.items()}
+        self.rows = {}  # grade -> CSV rows in export order
+        self.cells = {}  # (grade, day, section, slot) -> its row
+        self.busy = {}  # (day, slot) -> {teacher: (grade, section)}
+        self.teacher_classes = {}  # teacher -> {(grade, day, section, slot)}, in order of first appearance
+        self.class_teachers = {}  # (grade, section) -> Counter of teachers
+        self.teacher_subjects = {}  # teacher -> Counter of subjects
+        self.changed = set()  # grades with edits not saved yet
+
+    @classmethod
+    def load(cls, time_slots, grade_numbers, directory='out'):
+        schedule = cls(time_slots)
+        for grade in grade_numbers:
+            path = os.path.join(directory, f"Grade{grade}_Schedule.csv")
+            if not os.path.exists(path):
+                continue
+            with open(path, newline='') as file:
+                reader = csv.reader(file)
+                next(reader)  # Skip the header row
+                for row in reader:
+                    schedule.add(row)
+        return schedule
+
+    @classmethod
+    def from_solution(cls, model, solution):
+        schedule = cls(model.time_slots)
+        for var, value in enumerate(solution):
+            grade, day, section, slot = model.variable_keys[var]
+            subject, teacher = model.value_names[value] if value >= 0 else ("Free Period", "N/A")
+            schedule.add([grade, day, section, model.time_slots[slot], subject, teacher])
+        return schedule
+
+    def add(self, row):
+        grade = int(row[0])
+        key = (grade, row[1], row[2], self.slot_ids[row[3]])
+        self.rows.setdefault(grade, []).append(row)
+        self.cells[key] = row
+        self._index(key, row[4], row[5], 1)
+
+    def _index(self, key, subject, teacher, count):
+        if teacher == "N/A":
+            return
+        grade, day, section, slot = key
+        classes = self.teacher_classes.setdefault(teacher, set())
+        busy = self.busy.setdefault((day, slot), {})
+        if count > 0:
+            classes.add(key)
+            busy[teacher] = (grade, section)
+        else:
+            classes.discard(key)
+            del busy[teacher]
+        self.class_teachers.setdefault((grade, section), Counter())[teacher] += count
+        self.teacher_subjects.setdefault(teacher, Counter())[subject] += count
+
+    def is_busy(self, teacher, day, slot):
+        return teacher in self.busy.get((day, slot), ())
+
+    def teachers(self):
+        return self.teacher_classes
+
+    def teaches_section(self, teacher, grade, section):
+        return bool(self.class_teachers.get((grade, section), {}).get(teacher))
+
+    def teaches_subject(self, teacher, subject):
+        return bool(self.teacher_subjects.get(teacher, {}).get(subject))
+
+    def reassign(self, key, subject, teacher):
+        row = self.cells[key]
+        self._index(key, row[4], row[5], -1)
+        row[4], row[5] = subject, teacher
+        self._index(key, subject, teacher, 1)
+        self.changed.add(key[0])
+
+    def save(self, directory='out'):
+        # every changed grade replaces its CSV file in one step
+        for grade in sorted(self.changed):
+            _replace_file(os.path.join(directory, f"Grade{grade}_Schedule.csv"),
+                          lambda file, grade=grade: self._write_rows(grade, file), newline='')
+        self.changed.clear()
+
+    def _write_rows(self, grade, file):
+        writer = csv.writer(file)
+        writer.writerow(self.header)
+        writer.writerows(self.rows[grade])
+
+
+class ScheduleStore(Substitutions):
+    # The exported timetable in an SQLite database, the one copy everything else is generated from.
+    # Rows are kept in export order and indexed by teacher, (day, slot) and (grade, section) for the
+    # substitution and lookup queries; a week is written in one transaction, a substitution updates
+    # its row only, and the per-grade CSV and text files are streamed out of it.
+    header = Schedule.header
+
+    def __init__(self, path, time_slots):
+        self.time_slots = time_slots
+        self.slot_ids = {time_range: slot for slot, time_range in time_slots.items()}
+        self.changed = set()  # grades with substitutions not exported yet
+        self._teachers = None  # in order of first appearance when first asked, like Schedule.teacher_classes
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS classes (
+                position INTEGER PRIMARY KEY, grade INTEGER, day TEXT, section TEXT, slot INTEGER,
+                time_range TEXT, subject TEXT, teacher TEXT, UNIQUE (grade, day, section, slot));
+            CREATE INDEX IF NOT EXISTS classes_teacher ON classes (teacher);
+            CREATE INDEX IF NOT EXISTS classes_day_slot ON classes (day, slot);
+            CREATE INDEX IF NOT EXISTS classes_grade_section ON classes (grade, section);
+        """)
+
+    def close(self):
+        self.connection.close()
+
+    def write_week(self, rows):
+        # rows as in the CSV export, [grade, day, section, time range, subject, teacher], replace the week
+        self._teachers = None
+        with self.connection:
+            self.connection.execute("DELETE FROM classes")
+            self.connection.executemany(
+                "INSERT INTO classes (grade, day, section, slot, time_range, subject, teacher) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((int(row[0]), row[1], row[2], self.slot_ids[row[3]], row[3], row[4], row[5]) for row in rows))
+
+    def grades(self):
+        return [grade for grade, in self.connection.execute("SELECT DISTINCT grade FROM classes ORDER BY grade")]
+
+    def rows(self, grade):
+        return self.connection.execute(
+            "SELECT grade, day, section, time_range, subject, teacher FROM classes WHERE grade = ? ORDER BY position",
+            (grade,))
+
+    def teacher_week(self, teacher):
+        return self.connection.execute(
+            "SELECT grade, day, section, time_range, subject FROM classes WHERE teacher = ? ORDER BY position",
+            (teacher,)).fetchall()
+
+    def free_slots(self, teacher):
+        # (day, time range) of every slot in the week the teacher has no class in
+        return self.connection.execute(
+            "SELECT day, time_range FROM classes GROUP BY day, slot HAVING SUM(teacher = ?) = 0 "
+            "ORDER BY MIN(position)", (teacher,)).fetchall()
+
+    def write_csv(self, grade, file):
+        writer = csv.writer(file)
+        writer.writerow(self.header)
+        writer.writerows(self.rows(grade))
+
+    def write_text(self, grade, file):
+        file.write(f"Grade {grade} Weekly Schedule:\n")
+        current_day = current_section = None
+        for _, day, section, time_range, subject, teacher in self.rows(grade):
+            if day != current_day:
+                if current_day is not None:
+                    file.write("\n")
+                file.write(f"{day}:\n")
+                current_day, current_section = day, None
+            if section != current_section:
+                file.write(f"  Section {section}:\n")
+                current_section = section
+            if teacher == "N/A":
+                file.write(f"    {time_range}: Free Period\n")
+            else:
+                file.write(f"    {time_range}: {subject} (Teacher: {teacher})\n")
+        if current_day is not None:
+            file.write("\n")
 
+    def export(self, grade, directory='out'):
+        # (text path, CSV path) of the grade's views, each replaced in one step
+        paths = (os.path.join(directory, f"Grade{grade}_Schedule.txt"),
+                 os.path.join(directory, f"Grade{grade}_Schedule.csv"))
+        for path, write in zip(paths, (self.write_text, self.write_csv)):
+            _replace_file(path, lambda file, write=write: write(grade, file), newline='')
+        return paths
 
-csp_engine = CSPEngine(variables, domains, constraints)
-solution, conflicts = csp_engine.backtracking_search()
+    def teachers(self):
+        if self._teachers is None:
+            self._teachers = [teacher for teacher, in self.connection.execute(
+                "SELECT teacher FROM classes WHERE teacher != 'N/A' GROUP BY teacher ORDER BY MIN(position)")]
+        return self._teachers
 
-if solution:
+    def is_busy(self, teacher, day, slot):
+        return self.connection.execute("SELECT 1 FROM classes WHERE day = ? AND slot = ? AND teacher = ? LIMIT 1",
+                                       (day, slot, teacher)).fetchone() is not None
+
+    def teaches_section(self, teacher, grade, section):
+        return self.connection.execute("SELECT 1 FROM classes WHERE grade = ? AND section = ? AND teacher = ? LIMIT 1",
+                                       (grade, section, teacher)).fetchone() is not None
+
+    def teaches_subject(self, teacher, subject):
+        return self.connection.execute("SELECT 1 FROM classes WHERE teacher = ? AND subject = ? LIMIT 1",
+                                       (teacher, subject)).fetchone() is not None
+
+    def reassign(self, key, subject, teacher):
+        grade, day, section, slot = key
+        self.connection.execute(
+            "UPDATE classes SET subject = ?, teacher = ? WHERE grade = ? AND day = ? AND section = ? AND slot = ?",
+            (subject, teacher, grade, day, section, slot))
+        self.changed.add(grade)
+
+    def save(self, directory='out'):
+        # commits the substitutions made so far and brings the views of their grades up to date
+        self.connection.commit()
+        for grade in sorted(self.changed):
+            self.export(grade, directory)
+        self.changed.clear()
+
+
+def solve_timetable(grades, teacher_pool, time_slots, day_schedule_map, constraints, solver='backtracking',
+                    portfolio_workers=0, decompose=False, cache=None, time_limit=None, stop=None, **options):
+    # Solves a school that passed precheck, with the solver the driver's flags pick and options going to
+    # each CSPEngine. time_limit in seconds bounds every solver, but only the plain backtracking search
+    # settles for a partial timetable when it runs out; stop, a multiprocessing Event, ends any of them
+    # early once it is set, in place of a progress option. Returns (model, solution, conflicts, report):
+    # no solution comes with the conflicts behind it, or with None if the search was stopped first.
+    # report has 'source' ('search', 'portfolio', 'decomposition', or where cached_solve got it from), the
+    # search 'stats' and 'constraint_stats', the portfolio 'workers' or decomposed 'components' reports,
+    # and the classes left 'unfilled'.
+    model = build_model(grades, teacher_pool, time_slots, day_schedule_map)
+    report = {'source': 'search', 'stats': None, 'constraint_stats': {}, 'workers': [], 'components': [],
+              'unfilled': {}}
+    if portfolio_workers:
+        solution, conflicts, report['workers'] = portfolio_search(model, constraints, portfolio_workers,
+                                                                  time_limit=time_limit, stop=stop)
+        report['source'] = 'portfolio'
+    elif decompose:
+        solution, conflicts, report['components'] = decomposed_search(model, constraints, os.cpu_count() or 1,
+                                                                      time_limit=time_limit, stop=stop, **options)
+        report['source'] = 'decomposition'
+    elif cache is not None and solver != 'local':
+        if stop is not None or time_limit is not None:
+            deadline = None if time_limit is None else time.monotonic() + time_limit
+            options = dict(options, progress=_StopCheck(stop, deadline))
+        model, solution, conflicts, report['source'] = cached_solve(
+            cache, grades, teacher_pool, time_slots, day_schedule_map, constraints, **options)
+    else:
+        if stop is not None:
+            options = dict(options, progress=_StopCheck(stop))
+        if solver == 'local':
+            engine = LocalSearchEngine(model, constraints, time_limit=time_limit, progress=options.get('progress'))
+        else:
+            engine = CSPEngine(model, constraints, **options)
+        if time_limit is not None and solver != 'local':
+            _, solution, report['unfilled'] = engine.anytime_search(time_limit=time_limit)
+            conflicts = engine.conflict_log
+        else:
+            solution, conflicts = engine.solve()
+        report['stats'] = engine.stats
+        if solver != 'local':
+            report['constraint_stats'] = engine.constraint_stats()
+    return model, solution, conflicts, report
+
+
+def timetable_rows(model, solution, grades, time_slots, day_schedule_map):
+    # the week as CSV rows [grade, day, section, time range, subject, teacher] in export order, with a
+    # Free Period wherever the solution has no class
     schedule = {}
-    for var, value in solution.items():
-        subject, teacher = value
-        tokens = var.split('_')
-        g = int(tokens[0][1])
-        day = tokens[1]
-        s = tokens[2][1]
-        t = int(tokens[3][1])
+    for var, value in enumerate(solution):
+        if value < 0:
+            continue  # left unfilled, a Free Period
+        subject, teacher = model.value_names[value]
+        g, day, s, t = model.variable_keys[var]
         if g not in schedule:
             schedule[g] = {}
         if day not in schedule[g]:
@@ -317,66 +2567,122 @@ if solution:
             schedule[g][day][s] = {}
         schedule[g][day][s][t] = (subject, teacher)
 
-    for g in sorted(schedule.keys()):
-        output_lines = [f"Grade {g} Weekly Schedule:\n"]
-        output_data = [["Grade", "Day", "Section", "Time Slot", "Subject", "Teacher"]]
+    rows = []
+    for g in sorted(grade.grade_number for grade in grades):
+        grade_sections = next(grade.sections for grade in grades if grade.grade_number == g)
         for day in day_schedule_map.keys():
-            output_lines.append(f"{day}:\n")
-            d = day_schedule_map[day]
-            grade_sections = next(grade.sections for grade in grades if grade.grade_number == g)
             for s in grade_sections:
-                output_lines.append(f"  Section {s}:\n")
                 for t in sorted(time_slots):
-                    time_range = time_slots[t]
-                    if t in schedule[g][day][s]:
-                        subject, teacher = schedule[g][day][s][t]
-                        output_lines.append(f"    {time_range}: {subject} (Teacher: {teacher})\n")
-                        output_data.append([g, day, s, time_range, subject, teacher])
-                    else:
-                        output_lines.append(f"    {time_range}: Free Period\n")
-                        output_data.append([g, day, s, time_range, "Free Period", "N/A"])
-            output_lines.append("\n")
+                    subject, teacher = schedule.get(g, {}).get(day, {}).get(s, {}).get(t, ("Free Period", "N/A"))
+                    rows.append([g, day, s, time_slots[t], subject, teacher])
+    return rows
+
+
+def export_timetable(rows, time_slots, directory='out'):
+    # writes the week into directory/schedule.db, the source of truth, and the CSV and text views of
+    # each grade next to it; returns grade -> (text file, CSV file)
+    os.makedirs(directory, exist_ok=True)
+    store = ScheduleStore(os.path.join(directory, "schedule.db"), time_slots)
+    try:
+        store.write_week(rows)
+        return {g: store.export(g, directory) for g in store.grades()}
+    finally:
+        store.close()
+
+
+def remaining_hours(model, solution, teacher_pool):
+    # teacher name -> hours left after the solution, in teacher_pool order
+    assigned_hours = count_teacher_hours(model, solution)
+    return {t.name: t.max_hours - assigned_hours.get(t.name, 0) for t in teacher_pool}
+
+
+def substitute_teachers(absences, time_slots, grade_numbers, directory='out'):
+    # Covers each (teacher, grade, section, timeslot, day, subject) absence in the timetable exported to
+    # directory and saves it; returns the substitutes, None where nobody is free
+    path = os.path.join(directory, "schedule.db")
+    exported = os.path.exists(path)
+    store = ScheduleStore(path, time_slots)
+    try:
+        if not exported:
+            # exported before the store existed: take the week from the grade CSVs once
+            schedule = Schedule.load(time_slots, grade_numbers, directory)
+            store.write_week(row for grade in sorted(schedule.rows) for row in schedule.rows[grade])
+        substitutes = store.substitute_all(absences)
+        store.save(directory)
+    finally:
+        store.close()
+    return substitutes
+
+
+def main():
+    issues = precheck(grades, teacher_pool, day_schedule_map)
+    if issues is not None:
+        print("\n".join(issues))
+        return
+
+    model, solution, conflicts, report = solve_timetable(
+        grades, teacher_pool, time_slots, day_schedule_map, constraints, solver=_solver,
+        portfolio_workers=_portfolio_workers, decompose=_decompose,
+        cache=SolutionCache(_cache_dir) if _cache_dir else None, time_limit=_time_limit,
+        forward_checking=_forward_checking, arc_consistency=_arc_consistency, backjumping=_backjumping,
+        profile=_profile_search, symmetry=_symmetry)
+    if report['unfilled']:
+        print(f"Stopped with {len(report['unfilled'])} classes unfilled, exported as Free Period:")
+        for name, reasons in report['unfilled'].items():
+            print(f" - {name}: {' '.join(reasons)}")
+    if _print_search_stats:
+        for worker in report['workers']:
+            print(f"Worker {worker['worker']} ({worker['status']}{', winner' if worker.get('winner') else ''}):")
+            for name, count in worker.items():
+                if name not in ('worker', 'status', 'winner'):
+                    print(f" - {name}: {count}")
+        for component in report['components']:
+            print(f"Component {component['component']} ({component['status']}):")
+            for name, count in component.items():
+                if name not in ('component', 'status'):
+                    print(f" - {name}: {count}")
+        if report['stats'] is not None:
+            print("Search statistics:")
+            for name, count in report['stats'].items():
+                print(f" - {name}: {count}")
+            for name, profile in report['constraint_stats'].items():
+                print(f" - {name}: {profile['checks']} checks, {profile['rejections']} rejections, "
+                      f"{profile['time']:.4f}s")
+        elif report['source'] not in ('portfolio', 'decomposition'):
+            print(f"Timetable from: {report['source']}")
+
+    if solution:
+        rows = timetable_rows(model, solution, grades, time_slots, day_schedule_map)
         if _export:
-            filename_txt = f"out/Grade{g}_Schedule.txt"
-            with open(filename_txt, 'w') as file:
-                file.writelines(output_lines)
-            print(f"Schedule for Grade {g} has been exported to {filename_txt}.")
-
-            filename_csv = f"out/Grade{g}_Schedule.csv"
-            with open(filename_csv, mode='w', newline='') as file:
-                writer = csv.writer(file)
-                writer.writerows(output_data)
-            print(f"Schedule for Grade {g} has been exported to {filename_csv}.")
+            for g, (filename_txt, filename_csv) in export_timetable(rows, time_slots, "out").items():
+                print(f"Schedule for Grade {g} has been exported to {filename_txt}.")
+                print(f"Schedule for Grade {g} has been exported to {filename_csv}.")
         else:
-            print("".join(output_lines))
+            store = ScheduleStore(":memory:", time_slots)
+            store.write_week(rows)
+            for g in store.grades():
+                store.write_text(g, sys.stdout)
+                print()
+            store.close()
 
-    if _print_remaining_hours:
-        assigned_hours = count_teacher_hours(solution)
-        print("Remaining Hours for Each Teacher:")
-        for teacher_obj in teacher_pool:
-            used_hours = assigned_hours.get(teacher_obj.name, 0)
-            remaining = teacher_obj.max_hours - used_hours
-            print(f" - {teacher_obj.name}: {remaining} hours remaining")
-
-else:
-    print("No solution found.")
-    print("Due to the following Reasons:")
-    conf_sum = {}
-    for var, value, messages in conflicts or []:
-        for msg in messages:
-            conf_sum[msg] = conf_sum.get(msg, 0) + 1
-    for reason, count in conf_sum.items():
-        print(f"- {reason} (Occurred {count} times)")
-
-    # Check for max hours violations without alternatives again (final safety check)
-    for var, value, messages in conflicts or []:
-        for msg in messages:
-            if "Max Hours Constraint Violated" in msg:
-                subject, teacher = value
-                tokens = var.split('_')
-                grade_number = int(tokens[0][1])
-                var_domain = domains[var]
-                same_subject_entries = [t for (subj, t) in var_domain if subj == subject]
+        if _print_remaining_hours:
+            print("Remaining Hours for Each Teacher:")
+            for name, remaining in remaining_hours(model, solution, teacher_pool).items():
+                print(f" - {name}: {remaining} hours remaining")
+
+    else:
+        print("No solution found.")
+        if conflicts is None:
+            print("The search was stopped before it could finish.")
+            return
+        print("Due to the following Reasons:")
+        for reason, count in conflicts.summary().items():
+            print(f"- {reason} (Occurred {count} times)")
+
+        # Check for max hours violations without alternatives again (final safety check)
+        for reason, teacher, grade_number, subject, count in conflicts.entries():
+            if reason == 'constraint4':
+                same_subject_entries = [t.name for t in teacher_pool if (grade_number, subject) in t.grade_subject_pairs]
                 if len(same_subject_entries) == 1 and same_subject_entries[0] == teacher:
                     print("\nATTENTION: Scheduling Issue Detected!")
                     print(
@@ -386,141 +2692,29 @@ else:
                     print("Please resolve this issue by either increasing the teacher's max hours,")
                     print("or adding another qualified teacher for this subject and grade.")
 
-    print("\nRemaining Hours for Each Teacher (No assignment made):")
-    for teacher_obj in teacher_pool:
-        print(f" - {teacher_obj.name}: {teacher_obj.max_hours} hours remaining")
+        print("\nRemaining Hours for Each Teacher (No assignment made):")
+        for teacher_obj in teacher_pool:
+            print(f" - {teacher_obj.name}: {teacher_obj.max_hours} hours remaining")
+
+    substituteTeacher('T2', 1, 'A', '11:00am - 1:00pm', 'Monday', 'Math')
+
 
 def substituteTeacher(teacher, grade, section, timeslot, day, subject):
-    allteachList = []
-    teacherPool = teacherListMake()
-    for t in teacherPool.keys():
-        if t != teacher:
-            allteachList.append(t)
-
-    for i in range(1, len(grades) + 1):
-        with open(f'out/Grade{i}_Schedule.csv', 'r') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if numberAssignerDay(row[1]) == numberAssignerDay(day):
-                    if numberAssignerTime(row[3]) == numberAssignerTime(timeslot):
-                        if row[5] in allteachList:
-                            allteachList.remove(row[5])
-    teachDict = priortyList(grade, section, subject, timeslot, day, allteachList)
-    max_priority = 0
-    subTeach = ''
-    for i in teachDict.keys():
-        if max_priority < teachDict[i]:
-            max_priority = teachDict[i]
-            subTeach = i
-
-    # Modify the Grade CSV file with the substitute teacher
-    csv_file = f'out/Grade{grade}_Schedule.csv'
-    updated_rows = []
-
-    with open(csv_file, 'r') as file:
-        csv_reader = csv.reader(file)
-        header = next(csv_reader)  # Save the header row
-        updated_rows.append(header)
-        for row in csv_reader:
-            # Check if the row matches the specified section, timeslot, and day
-            if row[2] == section and row[3] == timeslot and row[1] == day:
-                # Update the teacher and subject
-                row[5] = subTeach
-                row[4] = subject
-            updated_rows.append(row)
-
-    # Write the updated rows back to the CSV file
-    with open(csv_file, 'w', newline='') as file:
-        csv_writer = csv.writer(file)
-        csv_writer.writerows(updated_rows)
-
-    print(
-        f"Substitute teacher {subTeach} assigned to Grade {grade}, Section {section}, Day {day}, Time Slot {timeslot} for Subject {subject}.")
-
-def priortyList(grade, section, subject, timeslot, day, allteachLists):
-    teachDict = {}
-    checkGrade = makeGradeList(grade)
-    for i in allteachLists:
-        teachDict[i] = 0
-        if i in checkGrade[section]:
-            teachDict[i] += 3
+    return substituteTeachers([(teacher, grade, section, timeslot, day, subject)])[0]
+
+
+def substituteTeachers(absences, directory='out'):
+    substitutes = substitute_teachers(absences, time_slots, [grade.grade_number for grade in grades], directory)
+    for (teacher, grade, section, timeslot, day, subject), substitute in zip(absences, substitutes):
+        if substitute is None:
+            print(f"No substitute teacher available for Grade {grade}, Section {section}, Day {day}, "
+                  f"Time Slot {timeslot}.")
         else:
-            if checkSubject(subject, i):
-                teachDict[i] += 2
-        if checkContClass(i, timeslot, day):
-            teachDict[i] += 1
-    return teachDict
-def makeGradeList(grade):
-    dictGrade = {}
-    with open(f'out/Grade{grade}_Schedule.csv', 'r') as file:
-        csv_reader = csv.reader(file)
-        next(csv_reader)  # Skip the header row
-        for row in csv_reader:
-            section = row[2]  # Section
-            teacher = row[5]  # Teacher
-            if section not in dictGrade:
-                dictGrade[section] = []
-            if teacher not in dictGrade[section]:
-                dictGrade[section].append(teacher)
-    print(dictGrade)
-    return dictGrade
-def checkSubject(subject, teacher_name):
-    teacherList = teacherListMake()
-    subjects = []
-    for i in teacherList.keys():
-        for y in teacherList[i]:
-            if y[2] not in subjects:
-                subjects.append(y[2])
-    if subject not in subjects:
-        return False
-    return True
-def checkContClass(teacher, timeslot, day):
-    timeslots = numberAssignerTime(timeslot)
-    days = numberAssignerDay(day)
-    if timeslots == 1:
-        checktime = [2]
-    elif timeslots == len(time_slots) - 1:
-        checktime = [len(time_slots) - 2]
-    else:
-        checktime = [timeslots - 1, timeslots + 1]
-    for i in range(1, len(grades) + 1):
-        with open(f'out/Grade{i}_Schedule.csv', 'r') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)
-            for row in csv_reader:
-                if numberAssignerDay(row[1]) == days:
-                    if (numberAssignerTime(row[3]) in checktime) and (row[5] == teacher):
-                        return False
-    return True
-def numberAssignerDay(day):
-    days = day_schedule_map[day]
-    return days
-def numberAssignerTime(timeslot):
-    for i in time_slots:
-        if time_slots[i] == timeslot:
-            return i
-def teacherListMake():
-    teacherPool = {}
-    for i in range(0,13):
-        try:
-            with open(f'out/Grade{i}_Schedule.csv', 'r') as file:
-                csv_reader = csv.reader(file)
-                next(csv_reader)
-                for row in csv_reader:
-                    section = row[2]  # Section
-                    teacher = row[5]
-                    grade = row[0]
-                    subject = row[4]
-                    if teacher not in teacherPool:
-                        teacherPool[teacher] = [[grade,section,subject]]
-                    else:
-                        if [grade,section,subject] not in teacherPool[teacher]:
-                            teacherPool[teacher].append([grade,section,subject])
-        except:
-            continue
-    return teacherPool
+            print(f"Substitute teacher {substitute} assigned to Grade {grade}, Section {section}, Day {day}, "
+                  f"Time Slot {timeslot} for Subject {subject}.")
+    return substitutes
 
 
-substituteTeacher('T2', 1, 'A', '11:00am - 1:00pm', 'Monday', 'Math')
+if __name__ == '__main__':
+    main()
 # 1,Monday,A,9:00am - 11:00am,English,T1
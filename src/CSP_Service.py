@@ -0,0 +1,331 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import CSP_Engine as csp
+
+# Job kinds
+SOLVE = 'solve'
+SUBSTITUTE = 'substitute'
+
+
+def _solve_job(grades, teacher_pool, time_slots, day_schedule_map, constraints, options, directory, stop):
+    # Runs in a pool process: precheck, solve and, given a directory, export one school. The result is
+    # JSON-ready, its 'status' one of 'solved', 'partial' (anytime search ran out of time), 'infeasible',
+    # 'unschedulable' (the precheck failed) or 'stopped'.
+    if stop.is_set():
+        return {'status': 'stopped'}  # cancelled while it waited for a worker
+    issues = csp.precheck(grades, teacher_pool, day_schedule_map)
+    if issues is not None:
+        return {'status': 'unschedulable', 'messages': [line for line in issues if line]}
+    options = dict(options)
+    cache_dir = options.pop('cache_dir', None)
+    model, solution, conflicts, report = csp.solve_timetable(
+        grades, teacher_pool, time_slots, day_schedule_map, constraints,
+        cache=csp.SolutionCache(cache_dir) if cache_dir else None, stop=stop, **options)
+    result = {'source': report['source'], 'stats': report['stats']}
+    if not solution:
+        if conflicts is None:
+            result['status'] = 'stopped'
+        else:
+            result.update(status='infeasible', conflicts=conflicts.summary())
+        return result
+    rows = csp.timetable_rows(model, solution, grades, time_slots, day_schedule_map)
+    result.update(status='partial' if report['unfilled'] else 'solved', timetable=rows, unfilled=report['unfilled'],
+                  remaining_hours=csp.remaining_hours(model, solution, teacher_pool))
+    if directory is not None:
+        result['files'] = csp.export_timetable(rows, time_slots, directory)
+    return result
+
+
+def _substitute_job(absences, time_slots, grade_numbers, directory):
+    substitutes = csp.substitute_teachers(absences, time_slots, grade_numbers, directory)
+    return {'status': 'done', 'substitutes': substitutes}
+
+
+class _Work:
+    # What the jobs with the same key share: the task doing it and, for solves, the event that
+    # tells the pool process to stop searching
+    def __init__(self, kind, key, stop):
+        self.kind = kind
+        self.key = key
+        self.stop = stop
+        self.jobs = set()
+        self.task = None
+
+
+class Job:
+    # One submission to a JobService. Awaiting it gives the result; cancel() or its timeout ends it with
+    # CancelledError or asyncio.TimeoutError, which only stops the work once no duplicate still waits.
+    def __init__(self, service, work, timeout):
+        loop = asyncio.get_running_loop()
+        self.kind = work.kind
+        self.key = work.key
+        self.future = loop.create_future()
+        self._timer = None if timeout is None else loop.call_later(timeout, self._expire, timeout)
+        self.future.add_done_callback(lambda _: self._done(service, work))
+
+    def __await__(self):
+        return self.future.__await__()
+
+    def done(self):
+        return self.future.done()
+
+    def cancel(self):
+        return self.future.cancel()
+
+    def _done(self, service, work):
+        if self._timer is not None:
+            self._timer.cancel()
+        service._release(self, work)
+
+    def _expire(self, timeout):
+        if not self.future.done():
+            self.future.set_exception(asyncio.TimeoutError(f"{self.kind} job did not finish within {timeout}s"))
+
+
+class JobService:
+    # Solve and substitution jobs for many schools, served by one long-running process. Solves run in a
+    # pool of max_workers processes that are started once and kept warm, substitutions in threads, and
+    # jobs writing into the same directory (one per school) take turns. A job submitted while an
+    # identical one is still running shares its work instead of repeating it. Every job can be
+    # cancelled or given a timeout; a solve nobody waits for any more stops within progress_every nodes.
+    # Jobs are submitted from the event loop's thread.
+    def __init__(self, max_workers=None, cache_dir=None, timeout=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.cache_dir = cache_dir  # SolutionCache directory for every solve, None for no cache
+        self.timeout = timeout  # seconds, for jobs submitted without one
+        self.stats = {'submitted': 0, 'coalesced': 0, 'completed': 0, 'cancelled': 0, 'timed_out': 0}
+        self._processes = None
+        self._threads = None
+        self._manager = None
+        self._running = {}  # key -> _Work still in progress
+        self._locks = {}  # directory -> asyncio.Lock
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close(cancel=exc_info[0] is not None)
+
+    def start(self):
+        # spawned rather than forked, as the event loop's process has threads by now
+        if self._processes is None:
+            context = multiprocessing.get_context('spawn')
+            self._manager = context.Manager()
+            self._processes = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            self._threads = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    async def close(self, cancel=False):
+        # waits for the jobs still running, or cancels them, then stops the workers
+        works = list(self._running.values())
+        if cancel:
+            for work in works:
+                for job in list(work.jobs):
+                    job.cancel()
+        await asyncio.gather(*(work.task for work in works), return_exceptions=True)
+        if self._processes is not None:
+            self._processes.shutdown()
+            self._threads.shutdown()
+            self._manager.shutdown()
+            self._processes, self._threads, self._manager = None, None, None
+
+    def solve(self, grades, teacher_pool, time_slots, day_schedule_map, constraints=csp.constraints, directory=None,
+              timeout=None, **options):
+        # Job solving the school with csp.solve_timetable(**options), exported into directory if given.
+        # Identical schools (see csp.problem_key) with the same options and directory are coalesced.
+        problem_key, _ = csp.problem_key(csp.canonical_problem(grades, teacher_pool, time_slots,
+                                                               day_schedule_map, constraints))
+        options = dict(options)
+        if self.cache_dir is not None:
+            options.setdefault('cache_dir', self.cache_dir)
+        key = (SOLVE, problem_key, list(day_schedule_map), json.dumps(options, sort_keys=True, default=repr),
+               self._directory(directory))
+        arguments = (grades, teacher_pool, time_slots, day_schedule_map, constraints, options, directory)
+        return self._submit(SOLVE, json.dumps(key), timeout,
+                            lambda work: self._run(directory, self._processes, _solve_job, *arguments, work.stop))
+
+    def substitute(self, directory, absences, time_slots, grade_numbers, timeout=None):
+        # Job covering (teacher, grade, section, timeslot, day, subject) absences in the timetable
+        # exported to directory, see csp.substitute_teachers
+        absences = [tuple(absence) for absence in absences]
+        key = (SUBSTITUTE, self._directory(directory), absences)
+        return self._submit(SUBSTITUTE, json.dumps(key), timeout,
+                            lambda work: self._run(directory, self._threads, _substitute_job, absences, time_slots,
+                                                   list(grade_numbers), directory))
+
+    @staticmethod
+    def _directory(directory):
+        return None if directory is None else os.path.realpath(directory)
+
+    def _submit(self, kind, key, timeout, run):
+        self.start()
+        self.stats['submitted'] += 1
+        work = self._running.get(key)
+        if work is None:
+            work = _Work(kind, key, self._manager.Event() if kind == SOLVE else None)
+            self._running[key] = work
+            work.task = asyncio.ensure_future(run(work))
+            work.task.add_done_callback(lambda task: self._finished(work, task))
+        else:
+            self.stats['coalesced'] += 1
+        job = Job(self, work, self.timeout if timeout is None else timeout)
+        work.jobs.add(job)
+        return job
+
+    async def _run(self, directory, executor, function, *arguments):
+        # runs function in the executor, holding the directory's lock until it has really finished
+        lock = None
+        if directory is not None:
+            lock = self._locks.setdefault(self._directory(directory), asyncio.Lock())
+            await lock.acquire()
+        try:
+            concurrent_future = executor.submit(function, *arguments)
+            future = asyncio.wrap_future(concurrent_future)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not concurrent_future.cancel():
+                    await asyncio.wait({future})  # already running: a solve notices its stop event soon
+                raise
+        finally:
+            if lock is not None:
+                lock.release()
+
+    def _finished(self, work, task):
+        if self._running.get(work.key) is work:
+            del self._running[work.key]
+        for job in list(work.jobs):
+            if job.future.done():
+                continue
+            if task.cancelled():
+                job.future.cancel()
+            elif task.exception() is not None:
+                job.future.set_exception(task.exception())
+            else:
+                job.future.set_result(task.result())
+
+    def _release(self, job, work):
+        # the job is over, whether it has its result, was cancelled or timed out
+        work.jobs.discard(job)
+        if job.future.cancelled():
+            self.stats['cancelled'] += 1
+        elif isinstance(job.future.exception(), asyncio.TimeoutError):
+            self.stats['timed_out'] += 1
+        else:
+            self.stats['completed'] += 1
+        if work.jobs or work.task.done():
+            return
+        # nobody waits for the work any more: stop it, and let a new duplicate start afresh
+        if self._running.get(work.key) is work:
+            del self._running[work.key]
+        if work.stop is not None:
+            work.stop.set()
+        work.task.cancel()
+
+
+async def serve(service, host='127.0.0.1', port=8765):
+    # A local socket taking one JSON request per line and answering each job with one JSON line
+    # carrying its id, in the order the jobs finish:
+    #   {"id": 1, "type": "solve", "school": <csp.school_problem form>, "directory": "out/school1",
+    #    "timeout": 60, "options": {"forward_checking": true, "backjumping": true}}
+    #   {"id": 2, "type": "substitute", "school": ..., "directory": "out/school1",
+    #    "absences": [["T2", 1, "A", "11:00am - 1:00pm", "Monday", "Math"]]}
+    #   {"id": 1, "type": "cancel"}
+    # The school's lists are read in the order given, so its days keep their weekday order in the exports;
+    # a csp.canonical_problem is accepted too but has its days sorted alphabetically.
+    async def handle(reader, writer):
+        jobs = {}
+        write_lock = asyncio.Lock()
+
+        async def reply(message):
+            async with write_lock:
+                writer.write(json.dumps(message).encode() + b'\n')
+                await writer.drain()
+
+        async def answer(request_id, job):
+            try:
+                result = await job
+            except asyncio.CancelledError:
+                if not job.future.cancelled():
+                    raise  # the connection is closing
+                result = {'status': 'cancelled'}
+            except asyncio.TimeoutError:
+                result = {'status': 'timeout'}
+            except Exception as error:
+                result = {'status': 'error', 'error': str(error)}
+            finally:
+                jobs.pop(request_id, None)
+            await reply(dict(result, id=request_id))
+
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    request_id = request.get('id')
+                    if request['type'] == 'cancel':
+                        if request_id in jobs:
+                            jobs[request_id].cancel()
+                        continue
+                    if request_id in jobs:
+                        raise ValueError(f"job {request_id} is still running")
+                    grades, teacher_pool, time_slots, day_schedule_map, constraints = \
+                        csp.school_from_problem(request['school'])
+                    if request['type'] == SOLVE:
+                        job = service.solve(grades, teacher_pool, time_slots, day_schedule_map, constraints,
+                                            request.get('directory'), request.get('timeout'),
+                                            **request.get('options', {}))
+                    elif request['type'] == SUBSTITUTE:
+                        job = service.substitute(request['directory'], request['absences'], time_slots,
+                                                 [grade.grade_number for grade in grades], request.get('timeout'))
+                    else:
+                        raise ValueError(f"unknown request type '{request['type']}'")
+                except (ValueError, KeyError, TypeError) as error:
+                    await reply({'id': request_id, 'status': 'error', 'error': str(error)})
+                    continue
+                jobs[request_id] = job
+                task = asyncio.ensure_future(answer(request_id, job))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for job in list(jobs.values()):
+                job.cancel()  # nobody is left to send the result to
+            await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def _run_server(args):
+    async with JobService(args.workers, args.cache, args.timeout) as service:
+        print(f"Serving timetable jobs on {args.host}:{args.port} with {service.max_workers} solver processes.")
+        await serve(service, args.host, args.port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve solve and substitution jobs for many schools.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, help="solver processes, one per CPU by default")
+    parser.add_argument('--cache', help="a SolutionCache directory shared by every solve")
+    parser.add_argument('--timeout', type=float, help="seconds, for jobs sent without one")
+    args = parser.parse_args()
+    try:
+        asyncio.run(_run_server(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
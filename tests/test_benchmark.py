@@ -0,0 +1,18 @@
+import pytest
+
+from CSP_Benchmark import generate_school
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('num_days', [1, 2])
+def test_sole_teacher_leaves_one_holder(seed, num_days):
+    grades, teacher_pool, day_schedule_map, time_slots = generate_school(
+        seed, num_grades=2, num_days=num_days, num_slots=3, sole_teacher=True)
+    taught = {(grade.grade_number, subject) for grade in grades for day_type in set(day_schedule_map.values())
+              for subject in grade.subjects_day[day_type]}
+    holders = {}
+    for teacher in teacher_pool:
+        for pair in teacher.grade_subject_pairs:
+            holders.setdefault(tuple(pair), []).append(teacher.name)
+    assert all(pair in holders for pair in taught)
+    assert any(len(holders[pair]) == 1 for pair in taught)
@@ -0,0 +1,41 @@
+import pytest
+
+import CSP_Engine as csp
+from CSP_Benchmark import generate_school
+
+
+# counts the timetables of a model by plain depth-first search over every domain value
+def brute_force_count(model):
+    index = csp.ScheduleIndex(model)
+    count = 0
+
+    def dfs(var):
+        nonlocal count
+        if var == len(model.domains):
+            count += 1
+            return
+        for value in model.domains[var]:
+            if all(constraint(var, value, index)[0] for constraint in csp.constraints):
+                index.assign(var, value)
+                dfs(var + 1)
+                index.unassign(var)
+
+    dfs(0)
+    return count
+
+
+@pytest.mark.parametrize('seed', [5, 16])
+@pytest.mark.parametrize('options', [
+    dict(),
+    dict(forward_checking=True),
+    dict(backjumping=True),
+    dict(forward_checking=True, backjumping=True),
+    dict(forward_checking=True, backjumping=True, arc_consistency=True),
+])
+def test_solutions_finds_every_timetable(seed, options):
+    grades, teacher_pool, day_schedule_map, time_slots = generate_school(
+        seed, num_grades=2, num_sections=1, num_days=1, num_slots=3, slack=1.0)
+    model = csp.build_model(grades, teacher_pool, time_slots, day_schedule_map)
+    engine = csp.CSPEngine(model, csp.constraints, **options)
+    found = [tuple(solution) for solution in engine.solutions()]
+    assert len(found) == len(set(found)) == brute_force_count(model)